@@ -3,57 +3,938 @@ import faiss
 import numpy as np
 import os
 import json
-from init_dbs import DB_PATH, FAISS_PATH, DIMENSION_EMBEDDING
+import logging
+import atexit
+import platform
+import struct
+import queue
+import threading
+import uuid
+from contextlib import contextmanager
+from init_dbs import (DB_PATH, FAISS_PATH, EMBEDDINGS_PATH, KV_PATH, DIMENSION_EMBEDDING,
+                      IVF_MUESTRAS_POR_CELDA, SQ_MUESTRAS_ENTRENAMIENTO, IVFFLAT_MUESTRAS_ENTRENAMIENTO,
+                      crear_indice_faiss, aplicar_parametros_busqueda, indice_base, migrar_esquema)
+
+logger = logging.getLogger(__name__)
+
+# Rol del proceso: "search" = worker de API que solo consulta (índice mmap de solo lectura).
+# DatabaseManager(solo_lectura=True/False) tiene prioridad sobre esta variable
+ROL = os.environ.get("GALERIA_ROLE", "writer")
+INTERVALO_GUARDADO_FAISS = 5  # segundos que se agrupan cambios antes de escribir el índice
+# HNSW no admite remove_ids: los rostros borrados se filtran en la búsqueda y el
+# índice se reconstruye (en segundo plano) cuando superan esta fracción
+FRACCION_BORRADOS_RECONSTRUIR = 0.1
+
+# --- SENTENCIAS SQL ---
+# Constantes a nivel de módulo: el mismo objeto str en cada llamada permite a
+# sqlite3 reutilizar la sentencia ya compilada de su caché (cached_statements)
+SQL_INSERTAR_FOTO = """INSERT INTO fotos (ruta_archivo, hash_md5, fingerprint_fast, fecha_creacion, ancho, alto) 
+                       VALUES (?, ?, ?, ?, ?, ?)"""
+SQL_FOTO_POR_HASH = "SELECT id FROM fotos WHERE hash_md5 = ?"
+SQL_FOTO_POR_RUTA = "SELECT id FROM fotos WHERE ruta_archivo = ?"
+SQL_FOTOS_POR_FINGERPRINT = "SELECT id, ruta_archivo, hash_md5 FROM fotos WHERE fingerprint_fast = ?"
+SQL_ACTUALIZAR_HASH_FOTO = "UPDATE fotos SET hash_md5 = ? WHERE id = ?"
+SQL_FOTOS_SIN_HUELLA = """SELECT id, ruta_archivo FROM fotos
+                          WHERE id > ? AND (fingerprint_fast IS NULL OR fingerprint_fast NOT LIKE ?)
+                          ORDER BY id LIMIT ?"""
+SQL_ACTUALIZAR_HUELLA_FOTO = "UPDATE fotos SET fingerprint_fast = ? WHERE id = ?"
+SQL_RUTA_FOTO = "SELECT ruta_archivo FROM fotos WHERE id = ?"
+SQL_ID_BD = "SELECT valor FROM metadatos_bd WHERE clave = 'id_bd'"
+SQL_GUARDAR_ID_BD = "INSERT INTO metadatos_bd (clave, valor) VALUES ('id_bd', ?)"
+SQL_FOTOS_PENDIENTES = "SELECT id FROM fotos WHERE procesada_facial = 0 ORDER BY id"
+SQL_FOTOS_PENDIENTES_LIMITE = SQL_FOTOS_PENDIENTES + " LIMIT ?"
+SQL_MARCAR_PROCESADA = "UPDATE fotos SET procesada_facial = 1 WHERE id = ?"
+SQL_MARCAR_ERROR = "UPDATE fotos SET procesada_facial = -1 WHERE id = ?"
+SQL_INSERTAR_ROSTRO = """INSERT INTO rostros_detectados 
+                         (foto_id, bbox_x, bbox_y, bbox_w, bbox_h, score_confianza) 
+                         VALUES (?, ?, ?, ?, ?, ?)"""
+SQL_INSERTAR_ROSTRO_PERSONA = """INSERT INTO rostros_detectados 
+                                 (foto_id, persona_id, bbox_x, bbox_y, bbox_w, bbox_h) 
+                                 VALUES (?, ?, ?, ?, ?, ?)"""
+SQL_ELIMINAR_ROSTRO = "DELETE FROM rostros_detectados WHERE id = ?"
+SQL_IDS_ROSTROS = "SELECT id FROM rostros_detectados ORDER BY id"
+SQL_COLUMNAS_ROSTROS = "PRAGMA table_info(rostros_detectados)"
+SQL_BLOBS_ROSTROS = "SELECT id, embedding_blob FROM rostros_detectados WHERE embedding_blob IS NOT NULL"
+SQL_PERSONAS_DE_ROSTROS = "SELECT id, persona_id FROM rostros_detectados WHERE id IN ({marcadores})"
+SQL_ROSTROS_CON_DATOS = """
+                SELECT r.id, p.nombre, f.ruta_archivo 
+                FROM rostros_detectados r
+                LEFT JOIN personas p ON r.persona_id = p.id
+                JOIN fotos f ON r.foto_id = f.id
+                WHERE r.id IN ({marcadores})
+            """
+SQL_INSERTAR_PERSONA = "INSERT INTO personas (nombre, es_conocida) VALUES (?, 0)"
+SQL_ACTUALIZAR_PERSONA = "UPDATE personas SET nombre = ?, etiqueta_id = ? WHERE id = ?"
+SQL_NOMBRE_PERSONA = "SELECT nombre FROM personas WHERE id = ?"
+SQL_RENOMBRAR_PERSONA = "UPDATE personas SET nombre = ?, es_conocida = 1 WHERE id = ?"
+SQL_ETIQUETA_DE_PERSONA = "SELECT etiqueta_id FROM personas WHERE id = ?"
+SQL_ETIQUETAS_DE_PERSONAS = "SELECT id, etiqueta_id FROM personas WHERE id IN ({marcadores})"
+SQL_INSERTAR_ETIQUETA = "INSERT OR IGNORE INTO etiquetas (texto, tipo, color) VALUES (?, ?, ?)"
+SQL_ETIQUETA_POR_TEXTO = "SELECT id FROM etiquetas WHERE texto = ?"
+SQL_ETIQUETAS_POR_TEXTO = "SELECT id, texto FROM etiquetas WHERE texto IN ({marcadores})"
+SQL_RENOMBRAR_ETIQUETA = "UPDATE etiquetas SET texto = ? WHERE texto = ? AND tipo = 'persona'"
+SQL_ASIGNAR_ETIQUETA = """INSERT OR IGNORE INTO fotos_etiquetas 
+                          (foto_id, etiqueta_id, asignacion_manual) VALUES (?, ?, ?)"""
+SQL_ULTIMO_ID = "SELECT last_insert_rowid()"
+
+# Los wheels de faiss-cpu traen núcleos AVX2/AVX-512 y eligen el adecuado al importar.
+# Si se carga el genérico (CPU antigua, FAISS_OPT_LEVEL=generic o FAISS compilado sin
+# -DFAISS_OPT_LEVEL=avx2 y -O3) el producto interno de 512 dims es ~2-4x más lento.
+def nivel_simd_faiss():
+    """Nivel SIMD con el que FAISS calcula distancias (p. ej. "AVX2", "AVX512", "NONE")."""
+    config = getattr(faiss, "SIMDConfig", None)
+    if config is not None and config.has_dynamic_dispatch():  # FAISS reciente: un solo binario
+        return config.get_level_name()
+    return faiss.get_compile_options()  # Wheels antiguos: "OPTIMIZE AVX2" si cargó swigfaiss_avx2
+
+FAISS_CON_SIMD = (
+    platform.machine().lower() not in ("x86_64", "amd64")  # ARM usa NEON/SVE, sin variantes AVX
+    or any(nivel in nivel_simd_faiss() for nivel in ("AVX2", "AVX512"))
+)
+if not FAISS_CON_SIMD:
+    print(f"⚠️ FAISS sin AVX2 ({nivel_simd_faiss() or 'genérico'}): las búsquedas irán por la ruta "
+          "escalar. Reinstala faiss-cpu o compílalo con -DFAISS_OPT_LEVEL=avx2")
+
+# Vectores con |‖x‖² - 1| por debajo de esto ya se consideran unitarios y no se tocan
+TOLERANCIA_NORMA = 1e-4
+
+# rocksdict es opcional: si no está, rostro -> persona se resuelve siempre en SQL
+try:
+    import rocksdict
+    ROCKSDICT_DISPONIBLE = True
+except ImportError:
+    ROCKSDICT_DISPONIBLE = False
+
+
+def normalizar_matriz(matriz):
+    """Normaliza (L2) IN-PLACE cada fila de una matriz float32 (N, d) contigua.
+    Si todas las filas ya son unitarias (p. ej. vectores que vienen del propio
+    índice) no se toca la matriz."""
+    # Todas las normas² en una pasada; si el lote ya es unitario nos ahorramos normalize_L2
+    normas2 = np.einsum('ij,ij->i', matriz, matriz)
+    if np.all(np.abs(normas2 - 1.0) < TOLERANCIA_NORMA):
+        return
+    faiss.normalize_L2(matriz)
+
+
+class ConnectionPool:
+    """
+    Pool de conexiones SQLite en modo WAL: varias conexiones de solo lectura
+    que pueden consultar a la vez y UNA conexión de escritura protegida por lock.
+    check_same_thread=False es vital para FastAPI (multihilo).
+    """
+    PRAGMAS = (
+        "PRAGMA journal_mode=WAL",
+        "PRAGMA synchronous=NORMAL",    # En WAL no hace falta fsync en cada commit
+        "PRAGMA temp_store=MEMORY",
+        "PRAGMA cache_size=-131072",    # 128 MB
+        "PRAGMA mmap_size=1073741824",  # 1 GB
+        "PRAGMA busy_timeout=5000",     # ms esperando si otro proceso tiene el lock
+        "PRAGMA foreign_keys=ON",
+    )
+
+    def __init__(self, db_path, lectores=4):
+        self.db_path = db_path
+        # El escritor se abre primero: es quien activa WAL en el archivo
+        self._escritor = self._abrir()
+        self._lock_escritura = threading.RLock()
+        self._profundidad = 0  # Nivel de anidamiento de write() (ver bulk())
+        self._al_confirmar = []  # Acciones pendientes del COMMIT exterior (ver al_confirmar)
+        self._lectores = queue.Queue()
+        self._todas = [self._escritor]
+        for _ in range(lectores):
+            conn = self._abrir(solo_lectura=True)
+            self._lectores.put(conn)
+            self._todas.append(conn)
+        # Un cursor reutilizable por conexión (cada una solo la usa un hilo a la vez)
+        self._cursores = {id(conn): conn.cursor() for conn in self._todas}
+
+    def _abrir(self, solo_lectura=False):
+        conn = sqlite3.connect(self.db_path, check_same_thread=False, cached_statements=256)
+        conn.row_factory = sqlite3.Row # Para acceder a columnas por nombre
+        for pragma in self.PRAGMAS:
+            conn.execute(pragma)
+        if solo_lectura:
+            conn.execute("PRAGMA query_only=1")
+        return conn
+
+    @contextmanager
+    def read(self):
+        """Presta una conexión de lectura (espera si están todas ocupadas)."""
+        conn = self._lectores.get()
+        try:
+            yield self._cursores[id(conn)]
+        finally:
+            self._lectores.put(conn)
+
+    @contextmanager
+    def write(self):
+        """Cursor de la conexión de escritura. Hace commit al salir del bloque
+        o rollback si se lanza una excepción (que se propaga).
+        Se puede anidar: los niveles interiores son SAVEPOINTs y solo el
+        exterior hace commit, así varias operaciones comparten una transacción."""
+        with self._lock_escritura:
+            marca = len(self._al_confirmar)
+            if self._profundidad == 0:
+                if not self._escritor.in_transaction:
+                    self._escritor.execute("BEGIN IMMEDIATE")
+                punto = None
+            else:
+                punto = f"nivel_{self._profundidad}"
+                self._escritor.execute(f"SAVEPOINT {punto}")
+            self._profundidad += 1
+
+            try:
+                # Los niveles anidados usan un cursor propio para no pisar al exterior
+                yield self._cursores[id(self._escritor)] if punto is None else self._escritor.cursor()
+            except BaseException:
+                self._profundidad -= 1
+                del self._al_confirmar[marca:]  # lo registrado en este nivel no llega a pasar
+                if punto is None:
+                    self._escritor.rollback()
+                else:
+                    self._escritor.execute(f"ROLLBACK TO {punto}")
+                    self._escritor.execute(f"RELEASE {punto}")
+                raise
+            else:
+                self._profundidad -= 1
+                if punto is None:
+                    self._escritor.commit()
+                    acciones, self._al_confirmar = self._al_confirmar, []
+                    for accion in acciones:
+                        accion()
+                else:
+                    self._escritor.execute(f"RELEASE {punto}")
+
+    def al_confirmar(self, accion):
+        """
+        Ejecuta accion() tras el COMMIT de la transacción en curso y la descarta
+        si se hace rollback. Fuera de write() se ejecuta en el momento.
+        Para lo que no es SQL (FAISS, memmap, caché) y depende de IDs de
+        AUTOINCREMENT: tras un rollback esos IDs se vuelven a asignar.
+        """
+        with self._lock_escritura:
+            if self._profundidad == 0:
+                accion()
+            else:
+                self._al_confirmar.append(accion)
+
+    def cerrar(self):
+        for conn in self._todas:
+            conn.close()
+
+
+class LockLecturaEscritura:
+    """
+    Lock del índice FAISS: las búsquedas (lectura) pueden ir a la vez, que
+    FAISS lo admite; las mutaciones (add, remove, entrenar, sustituir el
+    índice) van solas. La escritura es reentrante y tiene preferencia: si un
+    escritor espera, no entran lectores nuevos. Dentro de una escritura el
+    mismo hilo puede leer; al revés (pedir escritura leyendo) se bloquearía.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._lectores = 0
+        self._escritor = None  # hilo con la escritura
+        self._profundidad = 0  # anidamiento de escritura() en ese hilo
+        self._esperando = 0    # escritores en cola
+
+    @contextmanager
+    def lectura(self):
+        with self._cond:
+            if self._escritor != threading.get_ident():
+                while self._escritor is not None or self._esperando:
+                    self._cond.wait()
+            self._lectores += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._lectores -= 1
+                if self._lectores == 0:
+                    self._cond.notify_all()
+
+    @contextmanager
+    def escritura(self):
+        yo = threading.get_ident()
+        with self._cond:
+            if self._escritor != yo:
+                self._esperando += 1
+                while self._escritor is not None or self._lectores:
+                    self._cond.wait()
+                self._esperando -= 1
+                self._escritor = yo
+            self._profundidad += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._profundidad -= 1
+                if self._profundidad == 0:
+                    self._escritor = None
+                    self._cond.notify_all()
+
+
+class AlmacenEmbeddings:
+    """
+    Respaldo de los embeddings en un archivo float32 mapeado en memoria.
+    La fila i guarda el vector del rostro con id i (mismo ID que SQL y FAISS),
+    normalizado L2: el mismo que se añade al índice.
+    El archivo crece duplicando su tamaño cuando llega un ID fuera de rango.
+
+    La fila 0 no corresponde a ningún rostro (AUTOINCREMENT empieza en 1) y hace
+    de cabecera: MAGIA, dimensión, banderas y ntotal (filas ocupadas = id máximo + 1),
+    para que el archivo se pueda leer sin SQL ni FAISS.
+    """
+    CAPACIDAD_INICIAL = 1024
+    MAGIA = b"GALEMB01"
+    FORMATO_CABECERA = "<8sIIQ"  # magia, dimensión, banderas, ntotal
+    MIGRADO = 1  # bandera: ya se rellenó desde embedding_blob / FAISS (ver DatabaseManager._migrar_respaldo)
+
+    def __init__(self, ruta, dimension=DIMENSION_EMBEDDING):
+        self.ruta = ruta
+        self.dimension = dimension
+        self.mm = None
+        self.ntotal = 1  # la fila 0 es la cabecera
+        self.banderas = 0
+        self._lock = threading.Lock()
+
+        if not os.path.exists(self.ruta):
+            self._redimensionar(self.CAPACIDAD_INICIAL)
+        self._abrir()
+        self._leer_cabecera()
+
+    def _abrir(self):
+        filas = os.path.getsize(self.ruta) // (4 * self.dimension)
+        self.mm = np.memmap(self.ruta, dtype=np.float32, mode='r+', shape=(filas, self.dimension))
+
+    def _leer_cabecera(self):
+        cabecera = self.mm[0].view(np.uint8)
+        tamanio = struct.calcsize(self.FORMATO_CABECERA)
+        magia, dimension, banderas, ntotal = struct.unpack(self.FORMATO_CABECERA, cabecera[:tamanio].tobytes())
+
+        if magia == self.MAGIA:
+            if dimension != self.dimension:
+                raise ValueError(f"❌ Error: {self.ruta} guarda vectores de {dimension} dimensiones, no {self.dimension}")
+            self.ntotal = ntotal
+            self.banderas = banderas
+            return
+
+        # Archivo de antes de la cabecera: ntotal = última fila con datos + 1
+        ocupadas = np.flatnonzero(np.any(self.mm[1:] != 0, axis=1))
+        self.ntotal = int(ocupadas[-1]) + 2 if ocupadas.size else 1
+        self._escribir_cabecera()
+
+    def _escribir_cabecera(self):
+        cabecera = struct.pack(self.FORMATO_CABECERA, self.MAGIA, self.dimension, self.banderas, self.ntotal)
+        self.mm[0].view(np.uint8)[:len(cabecera)] = np.frombuffer(cabecera, dtype=np.uint8)
+
+    def _redimensionar(self, filas):
+        """Amplía el archivo (queda disperso: las filas sin usar no ocupan disco)."""
+        with open(self.ruta, 'ab') as f:
+            f.truncate(filas * self.dimension * 4)
+
+    def _asegurar_capacidad(self, id_maximo):
+        capacidad = self.mm.shape[0]
+        if id_maximo < capacidad:
+            return
+        while capacidad <= id_maximo:
+            capacidad *= 2
+        self.mm.flush()
+        self.mm = None
+        self._redimensionar(capacidad)
+        self._abrir()
+
+    def guardar(self, ids, vectores):
+        """Escribe los vectores en las filas indicadas por sus IDs de rostro."""
+        ids = np.asarray(ids, dtype='int64')
+        if ids.size and ids.min() < 1:
+            raise ValueError("❌ Error: la fila 0 del respaldo de embeddings es la cabecera")
+        with self._lock:
+            id_maximo = int(ids.max())
+            self._asegurar_capacidad(id_maximo)
+            self.mm[ids] = vectores
+            if id_maximo >= self.ntotal:
+                self.ntotal = id_maximo + 1
+                self._escribir_cabecera()
+
+    @property
+    def migrado(self):
+        return bool(self.banderas & self.MIGRADO)
+
+    def marcar_migrado(self):
+        with self._lock:
+            self.banderas |= self.MIGRADO
+            self._escribir_cabecera()
+
+    def obtener(self, id_rostro):
+        """Devuelve el vector de un rostro (vista sin copia sobre el archivo)."""
+        return self.mm[id_rostro]
+
+    def flush(self):
+        if self.mm is not None:
+            self.mm.flush()
+
+
+class CachePersonas:
+    """
+    Caché clave-valor (RocksDB) de rostro_id -> persona_id, lo que se pregunta
+    tras cada búsqueda en FAISS. SQL sigue siendo la fuente de verdad: la
+    persona de un rostro no cambia después de insertarlo, así que basta con
+    rellenar al leer y borrar al eliminar rostros. Los rostros sin persona no
+    se guardan aquí.
+
+    Eso solo vale mientras la caché corresponda a la misma galeria.db: si se
+    crea de nuevo, los ids de rostro vuelven a empezar en 1. Por eso la caché
+    guarda el id_bd de la BD (tabla metadatos_bd) y, si no coincide, el
+    escritor la vacía y un lector no la usa.
+    """
+    CLAVE_ID_BD = "id_bd"  # str: no choca con los ids de rostro (int)
+
+    def __init__(self, ruta, id_bd, solo_lectura=False):
+        self.ruta = ruta
+        self.solo_lectura = solo_lectura
+        acceso = rocksdict.AccessType.read_only() if solo_lectura else rocksdict.AccessType.read_write()
+        self.kv = rocksdict.Rdict(ruta, access_type=acceso)
+
+        if id_bd is None or self.kv.get(self.CLAVE_ID_BD) != id_bd:
+            if solo_lectura or id_bd is None:
+                self.kv.close()
+                raise ValueError(f"{ruta} no corresponde a esta base de datos")
+            self._vaciar()
+            self.kv[self.CLAVE_ID_BD] = id_bd
+
+    def _vaciar(self):
+        """Borra todas las entradas, de una BD anterior."""
+        lote = rocksdict.WriteBatch()
+        for clave in self.kv.keys():
+            lote.delete(clave)
+        self.kv.write(lote)
+
+    def obtener(self, ids_rostros):
+        """Devuelve {rostro_id: persona_id} de los IDs que están en la caché."""
+        valores = self.kv[list(ids_rostros)]
+        return {i: p for i, p in zip(ids_rostros, valores) if p is not None}
+
+    def guardar(self, persona_de):
+        """Escribe un lote {rostro_id: persona_id} (ignora los que no tienen persona)."""
+        if self.solo_lectura:
+            return
+        lote = rocksdict.WriteBatch()
+        for rostro_id, persona_id in persona_de.items():
+            if persona_id:
+                lote.put(int(rostro_id), int(persona_id))
+        self.kv.write(lote)
+
+    def eliminar(self, rostro_id):
+        if not self.solo_lectura:
+            del self.kv[int(rostro_id)]
+
+    def cerrar(self):
+        self.kv.close()
 
 
 class DatabaseManager:
-    def __init__(self, db_path=DB_PATH, faiss_path=FAISS_PATH, dimension=DIMENSION_EMBEDDING):
+    def __init__(self, db_path=DB_PATH, faiss_path=FAISS_PATH, dimension=DIMENSION_EMBEDDING,
+                 embeddings_path=EMBEDDINGS_PATH, solo_lectura=None, kv_path=KV_PATH):
         self.db_path = db_path
         self.faiss_path = faiss_path
+        self.embeddings_path = embeddings_path
+        self.kv_path = kv_path
         self.dimension = dimension
-        self.conn = None
+        self.pool = None
         self.index = None
+        self.embeddings = None  # AlmacenEmbeddings
+        self.cache_personas = None  # CachePersonas (solo si rocksdict está instalado)
+        self.id_bd = None  # identificador de galeria.db (tabla metadatos_bd)
+        # Solo búsquedas: índice en mmap y sin escrituras. Por defecto lo decide GALERIA_ROLE
+        self.solo_lectura = ROL == "search" if solo_lectura is None else solo_lectura
+        self.gpu_res = None  # Recursos CUDA si el índice vive en GPU
+        self._index_sin_entrenar = None  # Índice IVF a la espera de muestra suficiente
+
+        # FAISS admite búsquedas concurrentes pero no mutaciones: lectura() para buscar,
+        # escritura() para modificar o sustituir self.index
+        self._faiss_lock = LockLecturaEscritura()
+        self._faiss_dirty = False         # hay cambios en RAM sin escribir a disco
+        # Rostros borrados que siguen en un índice sin remove_ids (HNSW) y el
+        # IDSelector que los excluye de las búsquedas (None si no hay)
+        self._borrados = set()
+        self._lote_borrados = None
+        self._selector_borrados = None
+        self._lock_reconstruccion = threading.Lock()
+        self._hilo_reconstruccion = None
+        self._aviso_guardado = threading.Event()  # despierta al hilo faiss-writer
+        self._parar = threading.Event()
+        self._hilo_guardado = None
         
         self.conectar()
+        # Último volcado al salir del proceso aunque nadie llame a cerrar()
+        if not self.solo_lectura:
+            atexit.register(self.cerrar)
 
     def conectar(self):
         """Abre conexión a SQL y carga FAISS en RAM"""
-        # 1. SQL: check_same_thread=False es vital para FastAPI (multihilo)
-        self.conn = sqlite3.connect(self.db_path, check_same_thread=False)
-        self.conn.row_factory = sqlite3.Row # Para acceder a columnas por nombre
+        # 1. SQL: pool de lectores + un escritor (ver ConnectionPool)
+        self.pool = ConnectionPool(self.db_path)
+        if not self.solo_lectura:
+            # BD creadas con un esquema anterior (sin pasar por init_sql)
+            with self.pool.write() as cursor:
+                migrar_esquema(cursor)
+        self.id_bd = self._obtener_id_bd()
+        self.embeddings = AlmacenEmbeddings(self.embeddings_path, self.dimension)
+        self._abrir_cache_personas()
         
         # 2. FAISS
-        if os.path.exists(self.faiss_path):
+        if self.solo_lectura and os.path.exists(self.faiss_path):
+            # mmap: no espera a leer todo el archivo; el kernel lo va paginando bajo demanda
+            self.index = faiss.read_index(self.faiss_path, faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
+        elif os.path.exists(self.faiss_path):
             self.index = faiss.read_index(self.faiss_path)
         else:
             # Si no existe, creamos uno nuevo vacío con IDMap
-            index_base = faiss.IndexFlatIP(self.dimension)
-            self.index = faiss.IndexIDMap(index_base)
+            self.index = crear_indice_faiss(self.dimension)
+        aplicar_parametros_busqueda(self.index)
+
+        if not self.solo_lectura and not self.embeddings.migrado:
+            self._migrar_respaldo()
+
+        if not self._admite_borrado_directo(self.index):
+            # Lo que está en el índice pero ya no en SQL se borró sin reconstruir
+            en_indice = faiss.vector_to_array(self.index.id_map)
+            self._borrados = set(np.setdiff1d(en_indice, self._ids_rostros()).tolist())
+            self._actualizar_selector()
+
+        if not self.index.is_trained:
+            self._preparar_indice_provisional()
+
+        # 3. GPU: si hay CUDA, las búsquedas en lote son mucho más rápidas allí
+        if faiss.get_num_gpus() > 0:
+            self.mover_faiss_a_gpu()
+
+        # 4. Escritor en segundo plano del índice FAISS (solo el proceso escritor)
+        if not self.solo_lectura:
+            self._hilo_guardado = threading.Thread(target=self._bucle_guardado, name="faiss-writer", daemon=True)
+            self._hilo_guardado.start()
+            self._reconstruir_si_hace_falta()
+
+    def _obtener_id_bd(self):
+        """Identificador aleatorio de esta galeria.db; el escritor lo crea la primera vez.
+        None si un lector abre una BD que el escritor aún no ha migrado."""
+        if self.solo_lectura:
+            try:
+                with self.pool.read() as cursor:
+                    fila = cursor.execute(SQL_ID_BD).fetchone()
+            except sqlite3.OperationalError:
+                return None  # sin tabla metadatos_bd
+            return fila['valor'] if fila else None
+
+        with self.pool.write() as cursor:
+            fila = cursor.execute(SQL_ID_BD).fetchone()
+            if fila:
+                return fila['valor']
+            id_bd = uuid.uuid4().hex
+            cursor.execute(SQL_GUARDAR_ID_BD, (id_bd,))
+            return id_bd
+
+    def _abrir_cache_personas(self):
+        """Abre la caché RocksDB si se puede; si no, todo sigue funcionando contra SQL."""
+        if not ROCKSDICT_DISPONIBLE:
+            return
+        if self.solo_lectura and not os.path.exists(self.kv_path):
+            return  # el escritor todavía no la ha creado
+        try:
+            self.cache_personas = CachePersonas(self.kv_path, self.id_bd, self.solo_lectura)
+        except Exception as e:
+            # p. ej. otro proceso escritor tiene el LOCK de RocksDB, o la caché es de otra BD
+            print(f"⚠️ Caché de personas no disponible, se usa solo SQL: {e}")
+
+    def _preparar_indice_provisional(self):
+        """
+        Un índice IVF o "sq8" no admite vectores hasta entrenarlo. Mientras tanto las
+        caras se buscan y añaden en un IndexFlatIP provisional, reconstruido
+        con los rostros ya guardados (SQL + respaldo en memmap).
+        """
+        self._index_sin_entrenar = self.index
+        self.index = faiss.IndexIDMap2(faiss.IndexFlatIP(self.dimension))
+
+        ids, vectores = self._vectores_guardados()
+        if ids.size:
+            self.index.add_with_ids(vectores, ids)
+
+        self.train_if_needed()
+
+    def _ids_rostros(self):
+        with self.pool.read() as cursor:
+            cursor.execute(SQL_IDS_ROSTROS)
+            return np.array([fila['id'] for fila in cursor.fetchall()], dtype='int64')
+
+    def _vectores_guardados(self):
+        """IDs de los rostros de SQL y sus vectores (normalizados) del respaldo en memmap."""
+        return self._vectores_del_respaldo(self._ids_rostros())
+
+    def _vectores_del_respaldo(self, ids):
+        """Los ids indicados y sus vectores (normalizados) del respaldo en memmap.
+        Los rostros sin vector en el respaldo (fila fuera de rango o a cero) se avisan y se omiten."""
+        mm = self.embeddings.mm  # _redimensionar puede sustituirlo desde otro hilo
+        dentro = ids[ids < len(mm)]
+        vectores = np.array(mm[dentro])
+        con_vector = np.any(vectores != 0, axis=1)
+        perdidos = ids.size - int(con_vector.sum())
+        if perdidos:
+            print(f"⚠️ {perdidos} rostros sin vector en {self.embeddings_path}: quedan fuera del índice")
+        ids, vectores = dentro[con_vector], vectores[con_vector]
+        normalizar_matriz(vectores)  # respaldos antiguos con el vector sin normalizar
+        return ids, vectores
+
+    def _migrar_respaldo(self):
+        """
+        Una sola vez por archivo de respaldo: copia a embeddings.f32 los rostros
+        de SQL que aún no tienen vector allí. Salen de la columna embedding_blob
+        (bases de datos de antes del memmap) o, si no, del propio índice FAISS.
+        Sin esto, la primera reconstrucción del índice los perdería.
+        """
+        ids = self._ids_rostros()
+        dentro = ids[ids < self.embeddings.ntotal]
+        vacios = ~np.any(self.embeddings.mm[dentro] != 0, axis=1)
+        faltan = np.concatenate([dentro[vacios], ids[ids >= self.embeddings.ntotal]])
+
+        if faltan.size:
+            recuperados = self._vectores_antiguos(faltan)
+            if recuperados:
+                ids_recuperados = np.fromiter(recuperados.keys(), dtype='int64', count=len(recuperados))
+                vectores = np.stack(list(recuperados.values())).astype(np.float32)
+                normalizar_matriz(vectores)  # embedding_blob guardaba el vector original
+                self.embeddings.guardar(ids_recuperados, vectores)
+                self.embeddings.flush()
+            print(f"🔧 Respaldo de embeddings: {len(recuperados)} de {faltan.size} vectores recuperados")
+
+        self.embeddings.marcar_migrado()
+
+    def _vectores_antiguos(self, ids):
+        """{id: vector float32} de los rostros indicados, desde embedding_blob o FAISS."""
+        pendientes = set(ids.tolist())
+        recuperados = {}
+
+        with self.pool.read() as cursor:
+            columnas = {fila['name'] for fila in cursor.execute(SQL_COLUMNAS_ROSTROS).fetchall()}
+            if "embedding_blob" in columnas:
+                for fila in cursor.execute(SQL_BLOBS_ROSTROS).fetchall():
+                    vector = np.frombuffer(fila['embedding_blob'], dtype=np.float32)
+                    if fila['id'] in pendientes and vector.size == self.dimension:
+                        recuperados[fila['id']] = vector
+        pendientes -= recuperados.keys()
+
+        if pendientes and self.index.is_trained and self.index.ntotal:
+            try:
+                # IVF: reconstruct necesita un mapa id -> posición en las listas
+                faiss.extract_index_ivf(self.index).set_direct_map_type(faiss.DirectMap.Hashtable)
+            except RuntimeError:
+                pass
+            for rostro_id in pendientes:
+                try:
+                    # En "sq8"/"ivfsq8"/"ivfpq" sale aproximado: mejor eso que perderlo
+                    recuperados[rostro_id] = self.index.reconstruct(rostro_id)
+                except (RuntimeError, IndexError):
+                    pass  # no está en el índice (o el índice no admite reconstruct)
+        return recuperados
+
+    def _reconstruir_indice(self):
+        """
+        Crea de nuevo el índice sin los rostros borrados (ver _quitar_rostro).
+        Es O(n): se construye fuera del lock, con las búsquedas y altas en marcha,
+        y solo la sustitución final lo toma en escritura. Lo que se añada o borre
+        mientras tanto se aplica al índice nuevo antes de sustituirlo.
+        """
+        if self._admite_borrado_directo(self.index):
+            return  # remove_ids ya quitó los borrados
+        if not self._lock_reconstruccion.acquire(blocking=False):
+            return  # ya hay una reconstrucción en curso
+        try:
+            with self._faiss_lock.lectura():
+                en_indice = faiss.vector_to_array(self.index.id_map).astype('int64')
+                borrados = set(self._borrados)
+
+            ids, vectores = self._vectores_del_respaldo(en_indice[~np.isin(en_indice, list(borrados))])
+            print(f"⚙️ Reconstruyendo índice FAISS sin {len(borrados)} rostros borrados...")
+            nuevo = crear_indice_faiss(self.dimension, n_vectores=len(ids))
+            aplicar_parametros_busqueda(nuevo)
+            if not nuevo.is_trained:
+                nuevo.train(vectores)
+            if ids.size:
+                nuevo.add_with_ids(vectores, ids)
+
+            with self._faiss_lock.escritura():
+                # Altas y borrados llegados durante la construcción
+                recientes = np.setdiff1d(faiss.vector_to_array(self.index.id_map), en_indice)
+                if recientes.size:
+                    ids_recientes, vectores_recientes = self._vectores_del_respaldo(recientes.astype('int64'))
+                    nuevo.add_with_ids(vectores_recientes, ids_recientes)
+                pendientes = self._borrados - borrados
+                if pendientes and self._admite_borrado_directo(nuevo):
+                    nuevo.remove_ids(np.fromiter(pendientes, dtype='int64', count=len(pendientes)))
+                    pendientes = set()
+                self.index = nuevo
+                self._borrados = pendientes
+                self._actualizar_selector()
+                self._faiss_dirty = True
+        finally:
+            self._lock_reconstruccion.release()
+
+        if self.gpu_res is not None:
+            self.mover_faiss_a_gpu()
+        self.guardar_cambios_faiss()
+        print(f"✅ Índice FAISS reconstruido ({self.index.ntotal} vectores)")
+
+    def _reconstruir_si_hace_falta(self):
+        """Lanza _reconstruir_indice en un hilo si los borrados pendientes superan
+        FRACCION_BORRADOS_RECONSTRUIR del índice."""
+        if self.solo_lectura or len(self._borrados) <= FRACCION_BORRADOS_RECONSTRUIR * self.index.ntotal:
+            return
+        if self._hilo_reconstruccion and self._hilo_reconstruccion.is_alive():
+            return
+        self._hilo_reconstruccion = threading.Thread(target=self._reconstruir_indice, name="faiss-rebuild", daemon=True)
+        self._hilo_reconstruccion.start()
+
+    @staticmethod
+    def _admite_borrado_directo(index):
+        """remove_ids es seguro en los IVF sin envolver y en Flat / SQ dentro de
+        IndexIDMap2. HNSW no lo implementa y un IVF dentro de IndexIDMap2 (índices
+        antiguos) lo hace mal: deja las listas con posiciones que ya no son suyas."""
+        if not hasattr(index, "id_map"):
+            return True
+        return isinstance(indice_base(index), (faiss.IndexFlat, faiss.IndexScalarQuantizer))
+
+    def _actualizar_selector(self):
+        """Rehace el IDSelector que deja fuera de las búsquedas a self._borrados."""
+        if not self._borrados:
+            self._lote_borrados = self._selector_borrados = None
+            return
+        ids = np.fromiter(self._borrados, dtype='int64', count=len(self._borrados))
+        # Se guardan los dos: SWIG no mantiene vivo el lote desde IDSelectorNot
+        self._lote_borrados = faiss.IDSelectorBatch(ids)
+        self._selector_borrados = faiss.IDSelectorNot(self._lote_borrados)
+
+    def _buscar(self, consultas, k):
+        """index.search sin los rostros borrados pendientes de reconstrucción.
+        Se llama con self._faiss_lock en lectura."""
+        if self._selector_borrados is None:
+            return self.index.search(consultas, k)
+        # Parámetros nuevos en cada llamada: IndexIDMap2.search los modifica
+        # mientras busca. Llevan efSearch / nprobe del índice: si no, se usan los de por defecto
+        base = indice_base(self.index)
+        if hasattr(base, "hnsw"):
+            params = faiss.SearchParametersHNSW()
+            params.efSearch = base.hnsw.efSearch
+        else:
+            try:
+                nprobe = faiss.extract_index_ivf(base).nprobe
+                params = faiss.SearchParametersIVF()
+                params.nprobe = nprobe
+            except RuntimeError:
+                params = faiss.SearchParameters()
+        params.sel = self._selector_borrados
+        return self.index.search(consultas, k, params=params)
+
+    def train_if_needed(self, muestra=None):
+        """
+        Entrena el índice IVF / "sq8" (si lo hay pendiente) y le pasa los vectores
+        del índice provisional. Sin muestra explícita usa los vectores ya
+        registrados, y solo cuando hay suficientes (ver _muestras_necesarias).
+
+        Returns:
+            bool: True si el índice definitivo ya está entrenado.
+        """
+        if self._index_sin_entrenar is None:
+            return True
+
+        with self._faiss_lock.escritura():
+            destino = self._index_sin_entrenar
+            n = self.index.ntotal
+            if muestra is None and n < self._muestras_necesarias(destino):
+                return False
+
+            # Vectores ya normalizados del provisional, en el mismo orden que su id_map
+            vectores = self.index.index.reconstruct_n(0, n) if n else np.empty((0, self.dimension), dtype='float32')
+            ids = faiss.vector_to_array(self.index.id_map).astype('int64')
+
+            if muestra is None:
+                muestra = vectores
+            else:
+                muestra = np.array(muestra, dtype=np.float32)
+                normalizar_matriz(muestra)
+
+            if self._es_ivfflat(destino):
+                # nlist ≈ √n: ahora sí se sabe con cuántas caras se entrena
+                destino = crear_indice_faiss(self.dimension, "ivfflat", n_vectores=len(muestra))
+
+            print(f"⚙️ Entrenando índice FAISS con {len(muestra)} vectores...")
+            destino.train(muestra)
+            if n:
+                destino.add_with_ids(vectores, ids)
+            self.index = destino
+            self._index_sin_entrenar = None
+            self._faiss_dirty = True
+
+        if self.gpu_res is not None:
+            self.mover_faiss_a_gpu()
+        self.guardar_cambios_faiss()
+        print(f"✅ Índice FAISS entrenado ({self.index.ntotal} vectores)")
+        return True
+
+    @staticmethod
+    def _es_ivfflat(index):
+        return type(indice_base(index)) is faiss.IndexIVFFlat
+
+    @classmethod
+    def _muestras_necesarias(cls, index):
+        """Vectores con los que merece la pena entrenar: IVFFLAT_MUESTRAS_ENTRENAMIENTO
+        en "ivfflat", IVF_MUESTRAS_POR_CELDA por celda en los demás IVF y
+        SQ_MUESTRAS_ENTRENAMIENTO en la cuantización escalar."""
+        if cls._es_ivfflat(index):
+            return IVFFLAT_MUESTRAS_ENTRENAMIENTO
+        try:
+            return faiss.extract_index_ivf(index).nlist * IVF_MUESTRAS_POR_CELDA
+        except RuntimeError:
+            return SQ_MUESTRAS_ENTRENAMIENTO
+
+    def _indexar(self, vectores, ids):
+        """add_with_ids de vectores ya normalizados; entrena el IVF cuando toca."""
+        with self._faiss_lock.escritura():
+            self.index.add_with_ids(vectores, ids)
+            self._faiss_dirty = True
+        if self._index_sin_entrenar is not None:
+            self.train_if_needed()
+
+    def mover_faiss_a_gpu(self):
+        """Copia el índice a la GPU 0 (TIPO_INDICE "flat" -> GpuIndexFlatIP). Si el
+        tipo de índice no tiene versión GPU (p. ej. HNSW) se queda en CPU."""
+        with self._faiss_lock.escritura():
+            try:
+                # Los recursos CUDA (streams, memoria temporal) se reutilizan entre copias
+                recursos = self.gpu_res or faiss.StandardGpuResources()
+                self.index = faiss.index_cpu_to_gpu(recursos, 0, self.index)
+                self.gpu_res = recursos
+                print("⚡ Índice FAISS cargado en GPU")
+            except Exception as e:
+                self.gpu_res = None
+                print(f"⚠️ El índice FAISS se queda en CPU: {e}")
 
     def guardar_cambios_faiss(self):
-        """FAISS vive en RAM. Hay que guardar en disco explícitamente."""
-        faiss.write_index(self.index, self.faiss_path)
+        """FAISS vive en RAM. Marca el índice como modificado: el hilo
+        faiss-writer lo escribirá a disco en unos segundos, agrupando cambios."""
+        if self.solo_lectura or not self._faiss_dirty:
+            return  # Nada que guardar: no se reescribe el archivo
+        self._aviso_guardado.set()
+
+    def _comprobar_escritura(self):
+        """Los workers de búsqueda no pueden modificar el índice."""
+        if self.solo_lectura:
+            raise RuntimeError("❌ Error: DatabaseManager abierto en modo solo lectura (solo_lectura=True o GALERIA_ROLE=search).")
+
+    def _bucle_guardado(self):
+        while True:
+            self._aviso_guardado.wait()
+            # Esperamos un poco para juntar en una escritura los cambios que sigan llegando
+            if self._parar.is_set() or self._parar.wait(INTERVALO_GUARDADO_FAISS):
+                return  # cerrar() se encarga del guardado final
+            self._aviso_guardado.clear()
+            try:
+                self._escribir_faiss()
+            except Exception as e:
+                print(f"❌ Error guardando índice FAISS: {e}")
+
+    def _escribir_faiss(self):
+        """Escribe el índice en un .tmp y lo renombra: un corte a mitad nunca deja el archivo corrupto.
+        Bajo el lock solo se serializa a memoria (y en lectura: las búsquedas siguen);
+        la escritura a disco va fuera del lock."""
+        self.embeddings.flush()
+        ruta_tmp = self.faiss_path + ".tmp"
+        with self._faiss_lock.lectura():
+            if not self._faiss_dirty:
+                return
+            # Las mutaciones esperan a que acabe la lectura: cualquier add
+            # posterior lo volverá a marcar
+            self._faiss_dirty = False
+            # Con un IVF sin entrenar se guarda el IVF vacío: el provisional se
+            # reconstruye al arrancar desde SQL + memmap
+            if self._index_sin_entrenar is not None:
+                datos = faiss.serialize_index(self._index_sin_entrenar)
+            # Un índice en GPU no se puede serializar: se copia antes a CPU
+            elif self.gpu_res is not None:
+                datos = faiss.serialize_index(faiss.index_gpu_to_cpu(self.index))
+            else:
+                datos = faiss.serialize_index(self.index)
+        datos.tofile(ruta_tmp)
+        os.replace(ruta_tmp, self.faiss_path)
+
+    @contextmanager
+    def bulk(self):
+        """
+        Agrupa muchas escrituras (p. ej. importar cientos de fotos con
+        registrar_foto) en UNA transacción: un solo commit/fsync al final.
+
+            with db.bulk():
+                for ruta, hash_md5, meta in fotos:
+                    db.registrar_foto(ruta, hash_md5, meta)
+
+        Los cambios en FAISS, el respaldo y la caché de los rostros registrados o
+        borrados dentro se aplican en ese commit final; si hay rollback, no se aplican.
+        """
+        with self.pool.write():
+            yield self
+        self.guardar_cambios_faiss()
 
     # ==========================================
     # GESTIÓN DE FOTOS
     # ==========================================
-    def registrar_foto(self, ruta, hash_md5, metadatos):
+    def registrar_foto(self, ruta, hash_md5, metadatos, fingerprint=None):
         """
-        Inserta foto en SQL. Si ya existe (por hash), devuelve su ID existente.
+        Inserta foto en SQL. Si ya existe (por hash o por ruta), devuelve su ID existente.
+        hash_md5 puede ser None: solo se calcula cuando la huella rápida coincide con otra foto.
         """
-        cursor = self.conn.cursor()
         try:
-            cursor.execute(
-                """INSERT INTO fotos (ruta_archivo, hash_md5, fecha_creacion, ancho, alto) 
-                   VALUES (?, ?, ?, ?, ?)""",
-                (ruta, hash_md5, metadatos.get('fecha'), metadatos.get('ancho'), metadatos.get('alto'))
-            )
-            self.conn.commit()
-            return cursor.lastrowid
+            with self.pool.write() as cursor:
+                cursor.execute(
+                    SQL_INSERTAR_FOTO,
+                    (ruta, hash_md5, fingerprint, metadatos.get('fecha'), metadatos.get('ancho'), metadatos.get('alto'))
+                )
+                return cursor.lastrowid
         except sqlite3.IntegrityError:
-            # Si el hash ya existe, devolvemos el ID de la foto original
-            cursor.execute("SELECT id FROM fotos WHERE hash_md5 = ?", (hash_md5,))
-            return cursor.fetchone()['id']
+            # Si el hash (o la ruta) ya existe, devolvemos el ID de la foto original
+            # (por el escritor: dentro de bulk() la original puede no estar confirmada aún)
+            with self.pool.write() as cursor:
+                if hash_md5 is not None:
+                    cursor.execute(SQL_FOTO_POR_HASH, (hash_md5,))
+                    fila = cursor.fetchone()
+                    if fila:
+                        return fila['id']
+                cursor.execute(SQL_FOTO_POR_RUTA, (ruta,))
+                return cursor.fetchone()['id']
+
+    def obtener_fotos_por_fingerprint(self, fingerprint):
+        """Devuelve las fotos (id, ruta_archivo, hash_md5) con la misma huella rápida."""
+        # Por el escritor, igual que registrar_foto: dentro de bulk() hay fotos sin confirmar
+        with self.pool.write() as cursor:
+            cursor.execute(SQL_FOTOS_POR_FINGERPRINT, (fingerprint,))
+            return [dict(fila) for fila in cursor.fetchall()]
+
+    def actualizar_hash_foto(self, foto_id, hash_completo):
+        """Guarda el hash completo de una foto que se registró solo con su huella rápida."""
+        with self.pool.write() as cursor:
+            cursor.execute(SQL_ACTUALIZAR_HASH_FOTO, (hash_completo, foto_id))
+
+    def obtener_fotos_sin_huella(self, prefijo, desde_id=0, limite=500):
+        """Fotos (id, ruta_archivo) con id > desde_id cuya huella rápida falta
+        o no empieza por `prefijo` (calculada con otro algoritmo)."""
+        with self.pool.read() as cursor:
+            cursor.execute(SQL_FOTOS_SIN_HUELLA, (desde_id, prefijo + "%", limite))
+            return [dict(fila) for fila in cursor.fetchall()]
+
+    def actualizar_huellas(self, huellas):
+        """Guarda {foto_id: huella} en una sola transacción."""
+        with self.pool.write() as cursor:
+            cursor.executemany(SQL_ACTUALIZAR_HUELLA_FOTO, [(huella, foto_id) for foto_id, huella in huellas.items()])
 
     # ==========================================
     # GESTIÓN DE ROSTROS (HÍBRIDO SQL + FAISS)
@@ -63,83 +944,133 @@ class DatabaseManager:
         1. Guarda metadatos en SQL -> Obtenemos IDs
         2. Guarda vectores en FAISS usando ESOS IDs
         """
-        cursor = self.conn.cursor()
-        ids_generados = []
-        vectores_para_faiss = []
-        ids_para_faiss = []
+        self._comprobar_escritura()
+        if not lista_rostros_deepface:
+            return []
+
+        # Matriz contigua float32 reservada de antemano: se rellena fila a fila
+        # y FAISS la consume sin copias intermedias
+        n = len(lista_rostros_deepface)
+        matriz_vectores = np.empty((n, self.dimension), dtype=np.float32)
+        filas = []
 
-        for rostro in lista_rostros_deepface:
-            embedding = rostro['embedding']
+        for i, rostro in enumerate(lista_rostros_deepface):
             area = rostro['facial_area']
-            confianza = rostro['face_confidence']
-
-            # A. Insertar en SQL para obtener un ID único
-            cursor.execute(
-                """INSERT INTO rostros_detectados 
-                   (foto_id, bbox_x, bbox_y, bbox_w, bbox_h, score_confianza) 
-                   VALUES (?, ?, ?, ?, ?, ?)""",
-                (foto_id, area['x'], area['y'], area['w'], area['h'], confianza)
-            )
-            nuevo_id_sql = cursor.lastrowid
-            
-            # B. Preparar datos para FAISS
-            ids_generados.append(nuevo_id_sql)
-            vectores_para_faiss.append(embedding)
-            ids_para_faiss.append(nuevo_id_sql)
-
-        self.conn.commit()
-
-        # C. Insertar en FAISS (Batch operation es más rápida)
-        if vectores_para_faiss:
-            # Convertir a numpy float32 y normalizar (para similitud coseno)
-            matriz_vectores = np.array(vectores_para_faiss).astype('float32')
-            faiss.normalize_L2(matriz_vectores) 
-            
-            array_ids = np.array(ids_para_faiss).astype('int64')
-            
-            # MAGIA: Insertamos vector + ID específico
-            self.index.add_with_ids(matriz_vectores, array_ids)
-            self.guardar_cambios_faiss()
+            matriz_vectores[i] = rostro['embedding']
+            filas.append((foto_id, area['x'], area['y'], area['w'], area['h'], rostro['face_confidence']))
+        # La matriz es nuestra: se normaliza in-place para FAISS y el respaldo
+        normalizar_matriz(matriz_vectores)
+
+        # A. Insertar en SQL todas las caras en una sola llamada
+        with self.pool.write() as cursor:
+            cursor.executemany(SQL_INSERTAR_ROSTRO, filas)
+            # executemany no devuelve un lastrowid por fila, pero dentro de la
+            # transacción (y con un único escritor) AUTOINCREMENT asigna IDs
+            # consecutivos: el rango se deduce del último.
+            ultimo_id = cursor.execute(SQL_ULTIMO_ID).fetchone()[0]
 
-        return ids_generados
+            # B. IDs de SQL que usaremos también en FAISS
+            array_ids = np.arange(ultimo_id - n + 1, ultimo_id + 1, dtype='int64')
+
+            # C. Respaldo + FAISS (vector + ID específico, en lote) solo con el COMMIT:
+            # dentro de bulk() un rollback reutilizaría estos IDs
+            self.pool.al_confirmar(lambda: self._confirmar_rostros(array_ids, matriz_vectores))
+
+        self.guardar_cambios_faiss()
+
+        return array_ids.tolist()
+
+    def eliminar_rostro(self, rostro_id):
+        """
+        Borra un rostro de SQL y su vector de FAISS. Flat, SQ e IVF lo quitan
+        con remove_ids; en HNSW queda marcado como borrado (ver _quitar_rostro).
+
+        Returns:
+            bool: True si el rostro existía.
+        """
+        self._comprobar_escritura()
+        with self.pool.write() as cursor:
+            cursor.execute(SQL_ELIMINAR_ROSTRO, (rostro_id,))
+            if cursor.rowcount == 0:
+                return False
+            # Dentro de bulk() el borrado aún puede deshacerse: FAISS y caché al confirmar
+            self.pool.al_confirmar(lambda: self._quitar_rostro(rostro_id))
+
+        self.guardar_cambios_faiss()
+        return True
+
+    def _quitar_rostro(self, rostro_id):
+        """Quita de la caché y de FAISS un rostro ya borrado de SQL. Si el índice
+        no admite remove_ids, el vector se queda, las búsquedas lo filtran con
+        un IDSelector y el índice se reconstruye de vez en cuando, no en cada borrado."""
+        if self.cache_personas:
+            self.cache_personas.eliminar(rostro_id)
+
+        with self._faiss_lock.escritura():
+            if self._admite_borrado_directo(self.index):
+                self.index.remove_ids(np.array([rostro_id], dtype='int64'))
+            else:
+                self._borrados.add(rostro_id)
+                self._actualizar_selector()
+            self._faiss_dirty = True
+        self._reconstruir_si_hace_falta()
 
     # ==========================================
     # BÚSQUEDA (HÍBRIDO FAISS -> SQL)
     # ==========================================
+    def _preparar_consultas(self, vectores):
+        """
+        Contrato de entrada de búsquedas y altas: matriz (N, dimension) float32
+        C-contigua con filas unitarias, que es lo que ya entrega ArcFaceEmbedder.
+        Si `vectores` lo cumple se devuelve tal cual, sin copia; si no (listas,
+        float64, sin normalizar) se normaliza una copia y el array del llamador
+        no se toca. Un vector suelto (d,) se trata como (1, d).
+        """
+        matriz = np.asarray(vectores, dtype=np.float32).reshape(-1, self.dimension)
+        if matriz.flags['C_CONTIGUOUS']:
+            normas2 = np.einsum('ij,ij->i', matriz, matriz)
+            if np.all(np.abs(normas2 - 1.0) < TOLERANCIA_NORMA):
+                return matriz
+
+        matriz = np.array(matriz, dtype=np.float32, order='C')
+        # faiss directamente: se llama desde muchos hilos de la API a la vez
+        faiss.normalize_L2(matriz)
+        return matriz
+
     def buscar_rostros_similares(self, vector_query, limite=5, umbral_coseno=0.55):
         """
         Busca en FAISS y luego enriquece con datos de SQL
         """
-        # 1. Preparar vector
-        vector_np = np.array([vector_query]).astype('float32')
-        faiss.normalize_L2(vector_np)
+        # 1. Preparar vector: (1, 512) float32 unitario (sin copia si ya lo es)
+        vector_np = self._preparar_consultas(vector_query)
 
         # 2. Búsqueda en FAISS
         # distancias = similitud (coseno). Mayor es mejor (cerca de 1.0)
-        similitudes, ids_rostros = self.index.search(vector_np, k=limite)
+        with self._faiss_lock.lectura():
+            similitudes, ids_rostros = self._buscar(vector_np, limite)
         
-        resultados = []
-        cursor = self.conn.cursor()
+        # 3. Filtrar (vectorizado): fuera los ID -1 (no encontrado) y las distancias muy grandes
+        sims = similitudes[0]
+        ids = ids_rostros[0]
+        distancias = 1.0 - sims # Convertimos a distancia para comparar con tu umbral
+        mascara = (ids != -1) & (distancias <= umbral_coseno)
+        ids_validos = ids[mascara].astype(np.int64)
+        sims_validas = sims[mascara]
+        distancias_validas = distancias[mascara]
 
-        # 3. Cruzar datos
-        for i, id_rostro in enumerate(ids_rostros[0]):
-            similitud = similitudes[0][i]
-            distancia = 1 - similitud # Convertimos a distancia para comparar con tu umbral
+        if ids_validos.size == 0:
+            return []
 
-            # Filtro: Si el ID es -1 (no encontrado) o la distancia es muy grande
-            if id_rostro == -1 or distancia > umbral_coseno:
-                continue
+        # 4. Cruzar datos: una sola consulta para todos los candidatos
+        marcadores = ",".join("?" * ids_validos.size)
+        with self.pool.read() as cursor:
+            cursor.execute(SQL_ROSTROS_CON_DATOS.format(marcadores=marcadores), ids_validos.tolist())
+            filas = {fila['id']: fila for fila in cursor.fetchall()}
 
-            # Recuperar info de SQL
-            cursor.execute("""
-                SELECT r.id, p.nombre, f.ruta_archivo 
-                FROM rostros_detectados r
-                LEFT JOIN personas p ON r.persona_id = p.id
-                JOIN fotos f ON r.foto_id = f.id
-                WHERE r.id = ?
-            """, (int(id_rostro),))
-            
-            data = cursor.fetchone()
+        # Mantenemos el orden de FAISS (de más a menos similar)
+        resultados = []
+        for id_rostro, similitud, distancia in zip(ids_validos.tolist(), sims_validas, distancias_validas):
+            data = filas.get(id_rostro)
             if data:
                 resultados.append({
                     "id_rostro": data['id'],
@@ -162,11 +1093,11 @@ class DatabaseManager:
             return None, 1.0 # ID None, Distancia Máxima
 
         # 1. Preparar vector para FAISS (float32 y normalizado)
-        vector_np = np.array([embedding]).astype('float32')
-        faiss.normalize_L2(vector_np)
+        vector_np = self._preparar_consultas(embedding)
         
         # 2. Buscar el vecino más cercano (k=1)
-        similitudes, ids_rostros = self.index.search(vector_np, k=1)
+        with self._faiss_lock.lectura():
+            similitudes, ids_rostros = self._buscar(vector_np, 1)
         
         mejor_similitud = similitudes[0][0]
         id_rostro_encontrado = ids_rostros[0][0] # Este es el ID de la tabla rostros_detectados
@@ -177,166 +1108,274 @@ class DatabaseManager:
         # 4. Validar umbral
         if distancia < umbral and id_rostro_encontrado != -1:
             # ¡MATCH EN FAISS!
-            # Ahora preguntamos a SQL: "¿A qué persona pertenece este rostro ID X?"
-            cursor = self.conn.cursor()
-            cursor.execute(
-                "SELECT persona_id FROM rostros_detectados WHERE id = ?", 
-                (int(id_rostro_encontrado),)
-            )
-            resultado = cursor.fetchone()
-            
-            if resultado and resultado['persona_id']:
-                return resultado['persona_id'], distancia
+            # Ahora preguntamos: "¿A qué persona pertenece este rostro ID X?"
+            id_rostro_encontrado = int(id_rostro_encontrado)
+            persona_id = self._personas_de_rostros([id_rostro_encontrado]).get(id_rostro_encontrado)
+            if persona_id:
+                return persona_id, distancia
         
         # Si no supera el umbral o no se encuentra persona asociada
         return None, distancia
 
+    def identificar_personas_batch(self, embeddings, umbral=0.55):
+        """
+        Versión en lote de identificar_persona_por_vector: normaliza la matriz
+        (N, 512) una sola vez y hace UNA búsqueda en FAISS para todas las caras.
+
+        Returns:
+            tuple: (lista de persona_id o None, lista de distancias), una entrada por cara.
+        """
+        n = len(embeddings)
+        if self.index.ntotal == 0:  # si no hay caras guardadas
+            return [None] * n, [1.0] * n
+
+        # 1. Matriz float32 unitaria: la del llamador si ya cumple el contrato
+        consultas = self._preparar_consultas(embeddings)
+
+        # 2. Vecino más cercano de todas las caras en una sola llamada
+        with self._faiss_lock.lectura():
+            similitudes, ids_rostros = self._buscar(consultas, 1)
+        distancias = 1.0 - similitudes[:, 0]
+
+        # 3. Resolver la persona, con UNA consulta, solo de las que superan el umbral
+        ids_personas = [None] * n
+        coinciden = (ids_rostros[:, 0] != -1) & (distancias < umbral)
+        if not coinciden.any():
+            return ids_personas, distancias.tolist()
+
+        ids_coincidentes = np.unique(ids_rostros[coinciden, 0]).tolist()
+        persona_de = self._personas_de_rostros(ids_coincidentes)
+
+        for i in np.flatnonzero(coinciden):
+            ids_personas[i] = persona_de.get(int(ids_rostros[i, 0])) or None
+
+        return ids_personas, distancias.tolist()
+
+    def _personas_de_rostros(self, ids_rostros):
+        """
+        {rostro_id: persona_id} de los rostros indicados. Primero busca en la
+        caché RocksDB y solo los que falten van a SQL (una consulta IN); el
+        escritor guarda esos en la caché para la próxima vez.
+        """
+        persona_de = self.cache_personas.obtener(ids_rostros) if self.cache_personas else {}
+        faltan = [i for i in ids_rostros if i not in persona_de]
+        if not faltan:
+            return persona_de
+
+        marcadores = ",".join("?" * len(faltan))
+        with self.pool.read() as cursor:
+            cursor.execute(SQL_PERSONAS_DE_ROSTROS.format(marcadores=marcadores), faltan)
+            desde_sql = {fila['id']: fila['persona_id'] for fila in cursor.fetchall()}
+
+        if self.cache_personas:
+            self.cache_personas.guardar(desde_sql)
+        persona_de.update(desde_sql)
+        return persona_de
+
+    def medir_recall(self, consultas=None, k=1, n_consultas=200):
+        """
+        Compara el índice aproximado (HNSW/IVF) con una búsqueda exacta sobre
+        el respaldo de vectores. Validar antes de bajar HNSW_EF_SEARCH /
+        IVF_NPROBE o de cambiar TIPO_INDICE.
+
+        Args:
+            consultas (np.array): Embeddings que NO están en el índice (held-out).
+                Si falta, se usan n_consultas vectores guardados al azar.
+
+        Returns:
+            float: Fracción de los k vecinos exactos que devuelve el índice (1.0 = perfecto).
+        """
+        ids, vectores = self._vectores_guardados()
+        if ids.size == 0:
+            return 1.0
+
+        if consultas is None:
+            elegidos = np.random.default_rng(0).choice(ids.size, size=min(n_consultas, ids.size), replace=False)
+            consultas = vectores[elegidos]
+        else:
+            consultas = self._preparar_consultas(consultas)
+
+        exacto = faiss.IndexFlatIP(self.dimension)
+        exacto.add(vectores)
+        _, posiciones = exacto.search(consultas, k)
+        vecinos_exactos = ids[posiciones]
+
+        with self._faiss_lock.lectura():
+            _, vecinos = self._buscar(consultas, k)
+
+        aciertos = sum(np.intersect1d(a, b).size for a, b in zip(vecinos, vecinos_exactos))
+        recall = aciertos / vecinos_exactos.size
+        print(f"📏 Recall@{k} del índice FAISS: {recall:.3f} ({len(consultas)} consultas)")
+        return recall
+
     def crear_o_recuperar_etiqueta(self, texto, tipo='persona', color='#3498db'):
         """
         Crea una etiqueta si no existe, o devuelve el ID de la existente.
         Ideal para gestionar nombres de personas como etiquetas.
         """
-        cursor = self.conn.cursor()
-        try:
-            # Intentamos insertar
-            cursor.execute(
-                "INSERT INTO etiquetas (texto, tipo, color) VALUES (?, ?, ?)", 
-                (texto, tipo, color)
-            )
-            self.conn.commit()
-            return cursor.lastrowid
-            
-        except sqlite3.IntegrityError:
-            # Si falla porque el texto ya existe (UNIQUE constraint), recuperamos su ID
-            # Hacemos rollback parcial para limpiar el estado de error de la conexión
-            self.conn.rollback() 
-            
-            cursor.execute("SELECT id FROM etiquetas WHERE texto = ?", (texto,))
-            resultado = cursor.fetchone()
-            if resultado:
-                return resultado[0] # Devolvemos el ID existente
-            return None
+        with self.pool.write() as cursor:
+            return self._crear_o_recuperar_etiqueta(cursor, texto, tipo, color)
 
-    def registrar_nueva_persona(self, foto_id, embedding, area, nombre="Persona Nueva"):
+    @staticmethod
+    def _crear_o_recuperar_etiqueta(cursor, texto, tipo='persona', color='#3498db'):
+        """Igual que crear_o_recuperar_etiqueta pero dentro de una transacción ya abierta."""
+        # INSERT OR IGNORE: si el texto ya existe (UNIQUE) no falla ni aborta la transacción
+        cursor.execute(SQL_INSERTAR_ETIQUETA, (texto, tipo, color))
+        cursor.execute(SQL_ETIQUETA_POR_TEXTO, (texto,))
+        resultado = cursor.fetchone()
+        if resultado:
+            return resultado[0] # Devolvemos el ID (nuevo o existente)
+        return None
+
+    def registrar_nueva_persona(self, foto_id, embedding, area, nombre=None):
         """
         Registra una nueva identidad en el sistema.
         
         Args:
             foto_id (int): ID de la foto en la tabla 'fotos'.
-            embedding (list/np.array): El vector de 512 números.
+            embedding (np.array): El vector de 512 números, float32 y unitario
+                (si no, se convierte con una copia; ver _preparar_consultas).
             area (dict/list): Coordenadas {'x':..., 'y':...} o lista.
-            nombre (str): Nombre para asignar.
+            nombre (str): Nombre para asignar. Si falta, "Desconocido <id>" con el
+                id que asigna el INSERT (sin consultar antes el próximo id).
             
         Returns:
             int: El ID autogenerado de la nueva persona (persona_id).
         """
-        cursor = self.conn.cursor()
-        
+        # Caso particular del lote: mismas consultas y un solo camino que mantener
+        nuevo_persona_id = self.registrar_personas_batch(foto_id, [embedding], [area], [nombre])[0]
+        self.guardar_cambios_faiss()
+        return nuevo_persona_id
+
+    def registrar_personas_batch(self, foto_id, embeddings, areas, nombres=None):
+        """
+        Registra de una vez varias identidades nuevas, de una o varias fotos.
+        Hace los INSERT con executemany en una sola transacción y un único
+        add_with_ids en FAISS. NO marca el índice para guardar: hay que llamar a
+        guardar_cambios_faiss() al terminar el lote.
+
+        Args:
+            foto_id (int/list): ID de la foto en la tabla 'fotos', o uno por cara.
+            embeddings (np.array): Matriz (N, 512) float32 con filas unitarias, una
+                por cara (si no, se convierte con una copia; ver _preparar_consultas).
+            areas (list): Coordenadas de cada cara ({'x':...} o lista).
+            nombres (list): Nombres para asignar. Si falta, "Desconocido <id>".
+                Dentro de bulk() los vectores se indexan al confirmar: no reutilizar
+                el array de embeddings hasta entonces.
+
+        Returns:
+            list: Los IDs de las nuevas personas, en el mismo orden que embeddings.
+        """
+        self._comprobar_escritura()
+        n = len(embeddings)
+        if n == 0:
+            return []
+        if nombres is None:
+            nombres = [None] * n
+        fotos = list(foto_id) if isinstance(foto_id, (list, tuple, np.ndarray)) else [foto_id] * n
+
         try:
-            # 1. SQL: Crear la Persona
-            cursor.execute(
-                "INSERT INTO personas (nombre, es_conocida) VALUES (?, 0)", 
-                (nombre,)
-            )
-            nuevo_persona_id = cursor.lastrowid
-            
-            # 2. GENERAR NOMBRE AUTOMÁTICO (Si no venía uno)
-            if not nombre:
-                nombre_final = f"Desconocido {nuevo_persona_id}"
-            else:
-                nombre_final = nombre
+            with self.pool.write() as cursor:
+                # 1. SQL: Crear las Personas. AUTOINCREMENT asigna IDs consecutivos
+                # dentro de la transacción, así que el rango se deduce del último.
+                cursor.executemany(SQL_INSERTAR_PERSONA, [(nombre or "Desconocido",) for nombre in nombres])
+                ultimo_id = cursor.execute(SQL_ULTIMO_ID).fetchone()[0]
+                ids_personas = list(range(ultimo_id - n + 1, ultimo_id + 1))
 
-            # 3. CREAR ETIQUETA Y ASIGNAR
-            etiqueta_id = self.crear_o_recuperar_etiqueta(texto=nombre_final, tipo='persona')
-            
-            cursor.execute(
-                "UPDATE personas SET nombre = ?, etiqueta_id = ? WHERE id = ?",
-                (nombre_final, etiqueta_id, nuevo_persona_id)
-            )
-
-            # 2. SQL: Guardar el Rostro detectado
-            # Convertimos el embedding a bytes (BLOB) para respaldo en SQL
-            embedding_blob = np.array(embedding, dtype='float32').tobytes()
-            
-            # Normalizamos datos del área (por si vienen como dict o lista)
-            x = area['x'] if isinstance(area, dict) else area[0]
-            y = area['y'] if isinstance(area, dict) else area[1]
-            w = area['w'] if isinstance(area, dict) else area[2]
-            h = area['h'] if isinstance(area, dict) else area[3]
-            
-            cursor.execute(
-                """INSERT INTO rostros_detectados 
-                   (foto_id, persona_id, bbox_x, bbox_y, bbox_w, bbox_h, embedding_blob) 
-                   VALUES (?, ?, ?, ?, ?, ?, ?)""",
-                (foto_id, nuevo_persona_id, x, y, w, h, embedding_blob)
-            )
-            nuevo_rostro_id = cursor.lastrowid # Este ID es vital para FAISS
-            
-            self.conn.commit()
+                nombres_finales = [
+                    nombre if nombre else f"Desconocido {persona_id}"
+                    for persona_id, nombre in zip(ids_personas, nombres)
+                ]
 
-            # 3. FAISS: Indexar el vector
-            vector_np = np.array([embedding]).astype('float32')
-            faiss.normalize_L2(vector_np)
-            
-            # Usamos el ID del ROSTRO para FAISS (no el de persona), 
-            # así si borras este rostro, no borras a la persona entera.
-            id_faiss = np.array([nuevo_rostro_id]).astype('int64')
-            
-            self.index.add_with_ids(vector_np, id_faiss)
-            self.guardar_cambios_faiss()
+                # 2. CREAR ETIQUETAS Y ASIGNAR
+                cursor.executemany(
+                    SQL_INSERTAR_ETIQUETA,
+                    [(nombre, 'persona', '#3498db') for nombre in nombres_finales]
+                )
+                marcadores = ",".join("?" * n)
+                cursor.execute(SQL_ETIQUETAS_POR_TEXTO.format(marcadores=marcadores), nombres_finales)
+                etiquetas = {fila['texto']: fila['id'] for fila in cursor.fetchall()}
+
+                cursor.executemany(
+                    SQL_ACTUALIZAR_PERSONA,
+                    [(nombre, etiquetas.get(nombre), persona_id)
+                     for persona_id, nombre in zip(ids_personas, nombres_finales)]
+                )
+
+                # 3. SQL: Guardar los Rostros detectados
+                matriz_vectores = self._preparar_consultas(embeddings)
+                filas_rostros = []
+                for id_foto, persona_id, area in zip(fotos, ids_personas, areas):
+                    x, y, w, h = self._normalizar_area(area)
+                    filas_rostros.append((id_foto, persona_id, x, y, w, h))
+
+                cursor.executemany(SQL_INSERTAR_ROSTRO_PERSONA, filas_rostros)
+                ultimo_rostro = cursor.execute(SQL_ULTIMO_ID).fetchone()[0]
+                ids_rostros = np.arange(ultimo_rostro - n + 1, ultimo_rostro + 1, dtype='int64')
 
-            print(f"✅ Persona registrada: {nombre} (ID: {nuevo_persona_id})")
-            return nuevo_persona_id
+                # 4. FAISS: Indexar todos los vectores de golpe (ya normalizados), pero
+                # solo con el COMMIT: dentro de bulk() un rollback reutilizaría estos IDs
+                persona_de = dict(zip(ids_rostros.tolist(), ids_personas))
+                self.pool.al_confirmar(lambda: self._confirmar_rostros(ids_rostros, matriz_vectores, persona_de))
+
+            # Se llama por cada foto con caras nuevas: debug perezoso, sin formatear la lista
+            logger.debug("✅ %d personas registradas (IDs: %s)", n, ids_personas)
+            return ids_personas
 
         except Exception as e:
-            self.conn.rollback()
-            print(f"❌ Error al registrar persona: {e}")
-            return None
+            print(f"❌ Error al registrar personas: {e}")
+            return [None] * n
+
+    def _confirmar_rostros(self, ids_rostros, vectores, persona_de=None):
+        """Respaldo, FAISS y caché de rostros que ya están confirmados en SQL.
+        vectores ya normalizados: van tal cual al respaldo y al índice."""
+        self.embeddings.guardar(ids_rostros, vectores)
+        self._indexar(vectores, ids_rostros)
+        if self.cache_personas and persona_de:
+            self.cache_personas.guardar(persona_de)
+
+    @staticmethod
+    def _normalizar_area(area):
+        """Devuelve (x, y, w, h) tanto si el área viene como dict o como lista."""
+        if isinstance(area, dict):
+            return area['x'], area['y'], area['w'], area['h']
+        return area[0], area[1], area[2], area[3]
 
     def renombrar_persona(self, persona_id, nuevo_nombre):
         """
         Cambia el nombre de una persona y actualiza su etiqueta automáticamente.
         Ej: De "Persona 55" a "Juan".
         """
-        cursor = self.conn.cursor()
         try:
-            # 1. Obtener el nombre antiguo para buscar su etiqueta
-            cursor.execute("SELECT nombre FROM personas WHERE id = ?", (persona_id,))
-            res = cursor.fetchone()
-            if not res:
-                return False
-            nombre_antiguo = res['nombre']
-
-            print(f"🔄 Renombrando '{nombre_antiguo}' a '{nuevo_nombre}'...")
-
-            # 2. Actualizar tabla PERSONAS
-            cursor.execute(
-                "UPDATE personas SET nombre = ?, es_conocida = 1 WHERE id = ?", 
-                (nuevo_nombre, persona_id)
-            )
-
-            # 3. Actualizar tabla ETIQUETAS
-            # Buscamos la etiqueta que tenía el nombre antiguo y le ponemos el nuevo
-            cursor.execute(
-                "UPDATE etiquetas SET texto = ? WHERE texto = ? AND tipo = 'persona'",
-                (nuevo_nombre, nombre_antiguo)
-            )
+            with self.pool.write() as cursor:
+                # 1. Obtener el nombre antiguo para buscar su etiqueta
+                cursor.execute(SQL_NOMBRE_PERSONA, (persona_id,))
+                res = cursor.fetchone()
+                if not res:
+                    return False
+                nombre_antiguo = res['nombre']
+
+                print(f"🔄 Renombrando '{nombre_antiguo}' a '{nuevo_nombre}'...")
+
+                # 2. Actualizar tabla PERSONAS
+                cursor.execute(SQL_RENOMBRAR_PERSONA, (nuevo_nombre, persona_id))
+
+                # 3. Actualizar tabla ETIQUETAS
+                # Buscamos la etiqueta que tenía el nombre antiguo y le ponemos el nuevo
+                cursor.execute(SQL_RENOMBRAR_ETIQUETA, (nuevo_nombre, nombre_antiguo))
             
-            # (Opcional) Si la etiqueta nueva YA existía (ej. fusionar dos personas), 
-            # SQLite daría error de UNIQUE en el paso 3. 
-            # Eso requeriría lógica de fusión más compleja (merge), 
-            # pero para empezar, un renombrado simple basta.
+                # (Opcional) Si la etiqueta nueva YA existía (ej. fusionar dos personas), 
+                # SQLite daría error de UNIQUE en el paso 3. 
+                # Eso requeriría lógica de fusión más compleja (merge), 
+                # pero para empezar, un renombrado simple basta.
 
-            self.conn.commit()
-            return True
+                return True
 
         except sqlite3.IntegrityError:
             print("⚠️ El nombre ya existe como etiqueta. (Aquí podrías implementar fusión de personas)")
-            self.conn.rollback()
             return False
         except Exception as e:
             print(f"❌ Error al renombrar: {e}")
-            self.conn.rollback()
             return False
 
     def asignar_etiqueta(self, foto_id, etiqueta_id, manual=False):
@@ -344,60 +1383,118 @@ class DatabaseManager:
         Método GENÉRICO para pegar una etiqueta a una foto.
         Sirve para personas, eventos, lugares, etc.
         """
-        cursor = self.conn.cursor()
         try:
             # INSERT OR IGNORE es vital para no fallar si ya estaba etiquetada
-            cursor.execute(
-                """INSERT OR IGNORE INTO fotos_etiquetas 
-                   (foto_id, etiqueta_id, asignacion_manual) VALUES (?, ?, ?)""",
-                (foto_id, etiqueta_id, 1 if manual else 0)
-            )
-            self.conn.commit()
+            with self.pool.write() as cursor:
+                cursor.execute(SQL_ASIGNAR_ETIQUETA, (foto_id, etiqueta_id, 1 if manual else 0))
             return True
         except Exception as e:
             print(f"❌ Error asignando etiqueta: {e}")
             return False
 
+    def asignar_etiquetas(self, foto_id, etiquetas_ids, manual=False):
+        """Versión en lote de asignar_etiqueta: un solo executemany y un commit."""
+        try:
+            with self.pool.write() as cursor:
+                cursor.executemany(
+                    SQL_ASIGNAR_ETIQUETA,
+                    [(foto_id, etiqueta_id, 1 if manual else 0) for etiqueta_id in etiquetas_ids]
+                )
+            return True
+        except Exception as e:
+            print(f"❌ Error asignando etiquetas: {e}")
+            return False
+
+    def obtener_etiquetas_de_personas(self, personas_ids):
+        """
+        Versión en lote de obtener_etiqueta_id_de_persona: una sola consulta IN.
+
+        Returns:
+            dict: {persona_id: etiqueta_id o None} para cada ID que existe.
+        """
+        ids = sorted({int(persona_id) for persona_id in personas_ids if persona_id})
+        if not ids:
+            return {}
+        marcadores = ",".join("?" * len(ids))
+        # Por el escritor: dentro de bulk() las personas recién registradas aún no están confirmadas
+        with self.pool.write() as cursor:
+            cursor.execute(SQL_ETIQUETAS_DE_PERSONAS.format(marcadores=marcadores), ids)
+            return {fila['id']: fila['etiqueta_id'] for fila in cursor.fetchall()}
+
     def obtener_etiqueta_id_de_persona(self, persona_id):
         """
         Devuelve el ID de la etiqueta asociada a una persona.
         """
-        cursor = self.conn.cursor()
-        cursor.execute("SELECT etiqueta_id FROM personas WHERE id = ?", (persona_id,))
-        resultado = cursor.fetchone()
+        with self.pool.read() as cursor:
+            cursor.execute(SQL_ETIQUETA_DE_PERSONA, (persona_id,))
+            resultado = cursor.fetchone()
         if resultado and resultado[0]:
             return resultado[0]
         return None
 
     def obtener_ruta_foto(self, foto_id):
         """Devuelve la ruta de archivo de una foto dado su ID."""
-        cursor = self.conn.cursor()
-        cursor.execute("SELECT ruta_archivo FROM fotos WHERE id = ?", (foto_id,))
-        resultado = cursor.fetchone()
+        with self.pool.read() as cursor:
+            cursor.execute(SQL_RUTA_FOTO, (foto_id,))
+            resultado = cursor.fetchone()
         if resultado:
             return resultado['ruta_archivo'] # Asumiendo row_factory = sqlite3.Row
             # Si no usas row_factory, sería resultado[0]
         return None
 
+    def obtener_fotos_pendientes(self, limite=None):
+        """Devuelve los IDs de las fotos que aún no tienen reconocimiento facial."""
+        with self.pool.read() as cursor:
+            if limite:
+                cursor.execute(SQL_FOTOS_PENDIENTES_LIMITE, (limite,))
+            else:
+                cursor.execute(SQL_FOTOS_PENDIENTES)
+            return [fila['id'] for fila in cursor.fetchall()]
+
     def marcar_foto_como_procesada(self, foto_id):
         """
         Marca la foto como procesada facialmente en la base de datos
         para evitar re-escanearla en el futuro.
         """
-        cursor = self.conn.cursor()
         try:
-            cursor.execute(
-                "UPDATE fotos SET procesada_facial = 1 WHERE id = ?", 
-                (foto_id,)
-            )
-            self.conn.commit()
+            with self.pool.write() as cursor:
+                cursor.execute(SQL_MARCAR_PROCESADA, (foto_id,))
             return True
         except Exception as e:
             print(f"❌ Error al marcar foto {foto_id} como procesada: {e}")
             return False
 
+    def marcar_foto_con_error(self, foto_id):
+        """
+        Saca de las pendientes una foto que no se puede procesar (archivo
+        borrado o movido): si no, obtener_fotos_pendientes la devolvería
+        siempre la primera y el lote nunca avanzaría.
+        """
+        try:
+            with self.pool.write() as cursor:
+                cursor.execute(SQL_MARCAR_ERROR, (foto_id,))
+            return True
+        except Exception as e:
+            print(f"❌ Error al marcar foto {foto_id} con error: {e}")
+            return False
+
     def cerrar(self):
-        if self.conn:
-            self.conn.close()
-        # Asegurar guardado final
-        self.guardar_cambios_faiss()
\ No newline at end of file
+        """Cierra las conexiones y escribe el índice FAISS si quedó algo pendiente.
+        Se puede llamar más de una vez; si no se llama, lo hace atexit."""
+        atexit.unregister(self.cerrar)
+        # Parar el escritor en segundo plano (set del aviso para despertarlo)
+        self._parar.set()
+        self._aviso_guardado.set()
+        if self._hilo_guardado:
+            self._hilo_guardado.join()
+        if self._hilo_reconstruccion:
+            self._hilo_reconstruccion.join()
+
+        if self.pool:
+            self.pool.cerrar()
+        if self.cache_personas:
+            self.cache_personas.cerrar()
+            self.cache_personas = None
+        # Asegurar guardado final (solo si quedó algo sin escribir)
+        if not self.solo_lectura:
+            self._escribir_faiss()
\ No newline at end of file
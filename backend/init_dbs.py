@@ -1,5 +1,7 @@
 import sqlite3
 import os
+import math
+from contextlib import closing
 import faiss
 import numpy as np
 
@@ -7,9 +9,39 @@ import numpy as np
 DATA_DIR = os.path.join(os.path.dirname(__file__), "data")
 DB_PATH = os.path.join(DATA_DIR, "galeria.db")
 FAISS_PATH = os.path.join(DATA_DIR, "embeddings.index")
+EMBEDDINGS_PATH = os.path.join(DATA_DIR, "embeddings.f32") # Respaldo de vectores (memmap)
+KV_PATH = os.path.join(DATA_DIR, "personas.rocks") # Caché rostro -> persona (RocksDB, opcional)
 DIMENSION_EMBEDDING = 512 # ArcFace usa 512 dimensiones
 
+# --- ÍNDICE FAISS ---
+# "hnsw"   -> grafo HNSW, búsqueda sub-lineal sin entrenamiento (por defecto)
+# "ivfsq8" -> IVF + cuantización escalar a int8: 512 B por cara en vez de 2 KB (requiere entrenar)
+# "ivfflat"-> IVF sin compresión, nlist ≈ √n con el tamaño real al entrenar (requiere entrenar)
+# "ivfpq"  -> IVF + Product Quantization para galerías de más de ~1M caras (requiere entrenar)
+# "sq8"    -> fuerza bruta sobre int8: 4x menos memoria que float32 (requiere entrenar)
+# "fp16"   -> fuerza bruta sobre float16: 2x menos memoria, sin entrenamiento
+# "flat"   -> fuerza bruta exacta (IndexFlatIP); con GPU pasa a GpuIndexFlatIP, HNSW no tiene versión GPU
+TIPO_INDICE = "hnsw"
+HNSW_M = 32                # Vecinos por nodo del grafo
+HNSW_EF_CONSTRUCTION = 200
+HNSW_EF_SEARCH = 64        # Mayor = más recall y búsquedas más lentas
+IVFPQ_FACTORY = "IVF4096,PQ64"
+IVF_NLIST = 256            # Celdas del cuantizador grueso para "ivfsq8"
+IVF_NPROBE = 16            # Celdas que se recorren en cada búsqueda IVF
+IVF_MUESTRAS_POR_CELDA = 39  # FAISS recomienda >= 39 vectores por celda para entrenar
+SQ_MUESTRAS_ENTRENAMIENTO = 1000  # Caras con las que se calculan los rangos de "sq8"
+IVFFLAT_MUESTRAS_ENTRENAMIENTO = 10000  # Caras con las que se entrena "ivfflat" (nlist ≈ 100)
+
 # --- ESQUEMA SQL ---
+# Identidad de la propia BD (clave 'id_bd', se crea al abrirla): la caché
+# personas.rocks la guarda para detectar que galeria.db se ha creado de nuevo
+SQL_TABLA_METADATOS = """
+CREATE TABLE IF NOT EXISTS metadatos_bd (
+    clave TEXT PRIMARY KEY,
+    valor TEXT
+);
+"""
+
 SQL_SCHEMA = """
 -- Habilitar Foreign Keys
 PRAGMA foreign_keys = ON;
@@ -18,7 +50,10 @@ PRAGMA foreign_keys = ON;
 CREATE TABLE IF NOT EXISTS fotos (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
     ruta_archivo TEXT NOT NULL UNIQUE,
-    hash_md5 TEXT UNIQUE,              -- Para detectar duplicados al importar
+    -- Hash del archivo completo, "<algoritmo>:<hex>" (blake3 o blake2b); NULL hasta que haga falta.
+    -- Se llama hash_md5 por compatibilidad: en BD antiguas guarda MD5 en hex, sin prefijo
+    hash_md5 TEXT UNIQUE,
+    fingerprint_fast TEXT,             -- Huella rápida "<algoritmo>:<hex>": tamaño + primeros y últimos 64 KB
     
     -- Metadatos básicos
     fecha_creacion TIMESTAMP,          -- EXIF Original
@@ -27,12 +62,13 @@ CREATE TABLE IF NOT EXISTS fotos (
     alto INTEGER,
     tamanio_bytes INTEGER,
     
-    -- Estado del procesamiento
+    -- Estado del procesamiento: 0 pendiente, 1 procesada, -1 error (el archivo ya no está)
     procesada_facial BOOLEAN DEFAULT 0
 );
 
 -- Índices para búsqueda rápida
 CREATE INDEX IF NOT EXISTS idx_fotos_hash ON fotos(hash_md5);
+CREATE INDEX IF NOT EXISTS idx_fotos_fingerprint ON fotos(fingerprint_fast);
 CREATE INDEX IF NOT EXISTS idx_fotos_fecha ON fotos(fecha_creacion);
 
 -- 2. TABLA PERSONAS (Identidades)
@@ -50,6 +86,8 @@ CREATE TABLE IF NOT EXISTS personas (
     FOREIGN KEY (etiqueta_id) REFERENCES etiquetas(id) ON DELETE SET NULL
 );
 
+CREATE INDEX IF NOT EXISTS idx_personas_etiqueta ON personas(etiqueta_id);
+
 -- 3. TABLA ROSTROS_DETECTADOS (El puente SQL <-> FAISS)
 CREATE TABLE IF NOT EXISTS rostros_detectados (
     id INTEGER PRIMARY KEY AUTOINCREMENT,  -- ESTE ID SE USARÁ EN FAISS
@@ -61,14 +99,15 @@ CREATE TABLE IF NOT EXISTS rostros_detectados (
     bbox_w INTEGER, bbox_h INTEGER,
     score_confianza REAL,
 
-    -- Respaldo del vector (BLOB) por seguridad
-    embedding_blob BLOB, 
+    -- El respaldo del vector va en embeddings.f32 (fila = id del rostro), no en SQL.
+    -- Las BD antiguas con embedding_blob se copian allí al abrir DatabaseManager
 
     FOREIGN KEY (foto_id) REFERENCES fotos(id) ON DELETE CASCADE,
     FOREIGN KEY (persona_id) REFERENCES personas(id) ON DELETE SET NULL
 );
 
 CREATE INDEX IF NOT EXISTS idx_rostros_persona ON rostros_detectados(persona_id);
+CREATE INDEX IF NOT EXISTS idx_rostros_foto ON rostros_detectados(foto_id);
 
 -- 4. TABLA ETIQUETAS
 CREATE TABLE IF NOT EXISTS etiquetas (
@@ -88,7 +127,73 @@ CREATE TABLE IF NOT EXISTS fotos_etiquetas (
     FOREIGN KEY (foto_id) REFERENCES fotos(id) ON DELETE CASCADE,
     FOREIGN KEY (etiqueta_id) REFERENCES etiquetas(id) ON DELETE CASCADE
 );
-"""
+
+-- 6. METADATOS DE LA BD
+""" + SQL_TABLA_METADATOS
+
+def crear_indice_faiss(dimension=DIMENSION_EMBEDDING, tipo=None, n_vectores=None):
+    """
+    Crea un índice FAISS vacío en el que el ID del vector es el mismo que el de
+    la tabla rostros_detectados. Los IVF guardan ellos mismos los IDs en sus
+    listas (add_with_ids y remove_ids nativos); el resto va envuelto en
+    IndexIDMap2. Un IVF dentro de IndexIDMap2 NO admite remove_ids: el envoltorio
+    compacta id_map, pero las listas conservan las posiciones antiguas.
+    Se usa producto interno: con vectores normalizados equivale a similitud coseno.
+    n_vectores (caras con las que se va a entrenar) fija nlist ≈ √n en "ivfflat".
+    tipo por defecto: TIPO_INDICE en el momento de la llamada.
+    """
+    tipo = tipo or TIPO_INDICE
+    # Los tipos IVF y "sq8" hay que entrenarlos (index.train(muestra)) antes de añadir vectores:
+    # DatabaseManager.train_if_needed se encarga cuando hay muestra suficiente
+    if tipo == "ivfpq":
+        index_ivf = faiss.index_factory(dimension, IVFPQ_FACTORY, faiss.METRIC_INNER_PRODUCT)
+        faiss.extract_index_ivf(index_ivf).nprobe = IVF_NPROBE
+        return index_ivf
+    if tipo == "ivfflat":
+        # Sin n_vectores todavía no se sabe el tamaño: train_if_needed lo rehace al entrenar
+        nlist = max(1, int(math.sqrt(n_vectores))) if n_vectores else IVF_NLIST
+        quantizer = faiss.IndexFlatIP(dimension)
+        index_ivf = faiss.IndexIVFFlat(quantizer, dimension, nlist, faiss.METRIC_INNER_PRODUCT)
+        index_ivf.nprobe = IVF_NPROBE
+        return index_ivf
+    if tipo == "ivfsq8":
+        quantizer = faiss.IndexFlatIP(dimension)
+        index_ivf = faiss.IndexIVFScalarQuantizer(
+            quantizer, dimension, IVF_NLIST, faiss.ScalarQuantizer.QT_8bit, faiss.METRIC_INNER_PRODUCT
+        )
+        index_ivf.nprobe = IVF_NPROBE
+        return index_ivf
+
+    if tipo == "flat":
+        index_base = faiss.IndexFlatIP(dimension)
+    elif tipo in ("sq8", "fp16"):
+        qtype = faiss.ScalarQuantizer.QT_8bit if tipo == "sq8" else faiss.ScalarQuantizer.QT_fp16
+        index_base = faiss.IndexScalarQuantizer(dimension, qtype, faiss.METRIC_INNER_PRODUCT)
+    else:
+        index_base = faiss.IndexHNSWFlat(dimension, HNSW_M, faiss.METRIC_INNER_PRODUCT)
+        index_base.hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+        index_base.hnsw.efSearch = HNSW_EF_SEARCH
+
+    return faiss.IndexIDMap2(index_base)
+
+def indice_base(index):
+    """El índice que guarda los vectores: el de dentro si va envuelto en IndexIDMap2."""
+    return faiss.downcast_index(index.index) if hasattr(index, "id_map") else index
+
+def aplicar_parametros_busqueda(index):
+    """
+    Aplica HNSW_EF_SEARCH / IVF_NPROBE a un índice creado o leído de disco.
+    write_index guarda los valores con los que se creó el índice, así que
+    sin esto un cambio en la configuración no afectaría a índices existentes.
+    """
+    base = indice_base(index)
+    if hasattr(base, "hnsw"):
+        base.hnsw.efSearch = HNSW_EF_SEARCH
+        return
+    try:
+        faiss.extract_index_ivf(base).nprobe = IVF_NPROBE
+    except RuntimeError:
+        pass  # Índice plano: búsqueda exacta, no hay nada que ajustar
 
 def init_directorios():
     """Crea la carpeta de datos si no existe"""
@@ -98,14 +203,27 @@ def init_directorios():
     else:
         print(f"📁 Directorio existente: {DATA_DIR}")
 
+def migrar_esquema(conn):
+    """Añade a una base de datos ya existente las columnas nuevas del esquema.
+    La llaman init_sql y DatabaseManager.conectar; conn puede ser una conexión o un cursor."""
+    columnas = {fila[1] for fila in conn.execute("PRAGMA table_info(fotos)")}
+    if columnas and "fingerprint_fast" not in columnas:
+        conn.execute("ALTER TABLE fotos ADD COLUMN fingerprint_fast TEXT")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_fotos_fingerprint ON fotos(fingerprint_fast)")
+        # Las fotos ya registradas las rellena procesador_de_fotos.rellenar_huellas
+        print("🔧 Columna fotos.fingerprint_fast añadida")
+    if columnas:
+        conn.execute(SQL_TABLA_METADATOS)
+
 def init_sql():
     """Inicializa la base de datos SQLite"""
     try:
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        cursor.executescript(SQL_SCHEMA)
-        conn.commit()
-        conn.close()
+        # closing: la conexión se cierra también si falla el esquema
+        with closing(sqlite3.connect(DB_PATH)) as conn:
+            conn.execute("PRAGMA journal_mode=WAL") # Persistente en el archivo
+            migrar_esquema(conn) # Antes del esquema: sus índices usan las columnas nuevas
+            conn.executescript(SQL_SCHEMA)
+            conn.commit()
         print(f"✅ Base de datos SQL inicializada en: {DB_PATH}")
     except Exception as e:
         print(f"❌ Error inicializando SQL: {e}")
@@ -120,8 +238,7 @@ def init_faiss():
 
     print("⚙️ Creando nuevo índice FAISS...")
     
-    index_base = faiss.IndexFlatIP(DIMENSION_EMBEDDING)
-    index_con_ids = faiss.IndexIDMap(index_base)
+    index_con_ids = crear_indice_faiss()
 
     faiss.write_index(index_con_ids, FAISS_PATH)
     print(f"✅ Índice FAISS creado y guardado en: {FAISS_PATH}")
@@ -1,152 +1,499 @@
-import json
+import logging
 import os
+import mmap
+import hashlib
 import sys
 import subprocess
-import faiss
+import threading
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
 import numpy as np
-import sqlite3
-from backend.db_manager import DatabaseManager
+from backend.db_manager import DatabaseManager, normalizar_matriz
 
 # Instalación de dependencias
 try:
     from deepface import DeepFace
+    from deepface.modules import preprocessing
 except ImportError:
     print("Instalando librerías necesarias...")
+    # faiss-cpu de PyPI ya incluye los núcleos AVX2/AVX-512 (db_manager avisa si no se cargan)
     subprocess.check_call([sys.executable, "-m", "pip", "install", "deepface", "tf-keras", "retina-face", "faiss-cpu"])
     from deepface import DeepFace
+    from deepface.modules import preprocessing
+
+import cv2  # Lo instala DeepFace como dependencia
+
+# BLAKE3 es opcional: sin él se usa BLAKE2b de hashlib (más lento, mismo uso)
+try:
+    from blake3 import blake3
+    BLAKE3_DISPONIBLE = True
+except ImportError:
+    BLAKE3_DISPONIBLE = False
+
+logger = logging.getLogger(__name__)
 
 # CONFIGURACIÓN
 UMBRAL_COINCIDENCIA = 0.55 
 MODELO = "ArcFace"
-DETECTOR = "retinaface"
+DETECTOR = "yunet"  # CNN de <1 MB sobre cv2.dnn: ~10x más rápido que RetinaFace en CPU con caras frontales
+DETECTOR_PRECISO = "retinaface"  # Backbone ResNet-50, solo con high_accuracy=True
+# Detectores que DeepFace comparte entre hilos y no son thread-safe: YuNet es un único
+# cv2.FaceDetectorYN y setInputSize + detect de dos hilos a la vez mezclan tamaños
+DETECTORES_SIN_HILOS = {"yunet"}
 DIMENSION_EMBEDDING = 512  # ArcFace genera embeddings de 512 dimensiones
+TAMANIO_LOTE = 64  # Caras por pasada del modelo ArcFace
+TAMANIO_LOTE_FOTOS = 32  # Fotos pendientes que se procesan por lote
+HILOS_DETECCION = os.cpu_count() or 1  # TF libera el GIL dentro de sus operaciones nativas
+LADO_MAXIMO_DETECCION = 1600  # px; por encima el detector no gana precisión y cuesta ~4x más
+BLOQUE_HUELLA = 64 * 1024  # Bytes del principio y del final que entran en la huella rápida
+LOTE_HUELLAS = 500  # Fotos antiguas a las que rellenar_huellas calcula la huella por transacción
+# Prefijo de huellas y hashes: no se comparan nunca valores de algoritmos distintos
+ALGORITMO_HASH = "blake3" if BLAKE3_DISPONIBLE else "blake2b"
 
-class ProcesadorDeFotos:
-    '''Se encarga de:
-        - calcular los embeddings de las caras de una foto
-        - registrar nuevas personas
-        - añadir las etiquetas'''
-    def __init__(self, id_foto):
-        self.db = DatabaseManager()
-        self.id_foto = id_foto
-        self.ruta_foto = self.db.obtener_ruta_foto(id_foto)
 
-        if not self.ruta_foto:
-            raise ValueError(f"❌ Error: No existe la foto con ID {id_foto} en la base de datos.")
-        
-        if not os.path.exists(self.ruta_foto):
-            raise FileNotFoundError(f"❌ Error: El archivo físico no existe: {self.ruta_foto}")
+def _nuevo_hash():
+    '''Hasher de 256 bits: BLAKE3 multihilo si está instalado, si no BLAKE2b.'''
+    if BLAKE3_DISPONIBLE:
+        return blake3(max_threads=blake3.AUTO)
+    return hashlib.blake2b(digest_size=32)
 
-    def obtener_caras(self, ruta_foto_nueva):
-        '''Obtiene las caras de una foto.'''
-        print(f"🚀 Iniciando sistema con {MODELO} y detector {DETECTOR}...")
-        print(f"😃 Obteniendo caras: {ruta_foto_nueva}...")
-        
-        try:
-            caras = DeepFace.represent(
-                img_path=ruta_foto_nueva, 
-                model_name=MODELO,
-                detector_backend=DETECTOR,
-                enforce_detection=True  
-            )
-            
-            if not caras: # si por alguna razón la lista llega vacía sin lanzar excepción
-                raise ValueError("Lista de caras vacía")
+def _resumen(hasher):
+    '''"<algoritmo>:<hex>", el formato de fingerprint_fast y hash_md5.'''
+    return f"{ALGORITMO_HASH}:{hasher.hexdigest()}"
+
+def compute_fingerprint(ruta_foto):
+    '''Huella rápida de un archivo: tamaño + primeros y últimos 64 KB.
+    Solo lee 128 KB aunque la foto pese decenas de MB; dos fotos con distinta
+    huella son distintas seguro, con la misma hay que comparar el hash completo.'''
+    tamanio = os.path.getsize(ruta_foto)
+    hasher = _nuevo_hash()
+    hasher.update(tamanio.to_bytes(8, "little"))
+    with open(ruta_foto, "rb") as archivo:
+        hasher.update(archivo.read(BLOQUE_HUELLA))
+        if tamanio > BLOQUE_HUELLA:
+            archivo.seek(max(BLOQUE_HUELLA, tamanio - BLOQUE_HUELLA))
+            hasher.update(archivo.read())
+    return _resumen(hasher)
+
+def calcular_hash_completo(ruta_foto):
+    '''Hash del archivo entero, leído con mmap (sin copiarlo a memoria).'''
+    hasher = _nuevo_hash()
+    if os.path.getsize(ruta_foto) == 0:  # mmap no admite archivos vacíos
+        return _resumen(hasher)
+    with open(ruta_foto, "rb") as archivo, mmap.mmap(archivo.fileno(), 0, access=mmap.ACCESS_READ) as datos:
+        hasher.update(datos)
+    return _resumen(hasher)
+
+_bases_con_huellas = weakref.WeakSet()  # DatabaseManager ya pasados por rellenar_huellas
+_huellas_lock = threading.Lock()
+
+def rellenar_huellas(db):
+    '''Calcula la huella rápida de las fotos que no la tienen (registradas antes
+    de fingerprint_fast) o que la tienen con otro algoritmo. Sin esto
+    importar_foto no las vería como candidatas y dejaría pasar sus duplicados.
+    Las fotos cuyo archivo ya no existe se quedan como están.
+    Devuelve cuántas huellas se han actualizado.'''
+    actualizadas = 0
+    ultimo_id = 0
+    while True:
+        fotos = db.obtener_fotos_sin_huella(ALGORITMO_HASH + ":", ultimo_id, LOTE_HUELLAS)
+        if not fotos:
+            break
+        ultimo_id = fotos[-1]["id"]
+        huellas = {foto["id"]: compute_fingerprint(foto["ruta_archivo"])
+                   for foto in fotos if os.path.exists(foto["ruta_archivo"])}
+        if huellas:
+            db.actualizar_huellas(huellas)
+            actualizadas += len(huellas)
+
+    _bases_con_huellas.add(db)
+    if actualizadas:
+        logger.info("🔧 Huella rápida calculada para %d fotos ya registradas", actualizadas)
+    return actualizadas
+
+def importar_foto(db, ruta_foto, metadatos=None):
+    '''Registra una foto en la base de datos evitando duplicados.
+    El hash completo solo se calcula si la huella rápida coincide con la de
+    otra foto; en el caso normal (foto nueva) se leen 128 KB del archivo.'''
+    if db not in _bases_con_huellas:
+        with _huellas_lock:
+            if db not in _bases_con_huellas:
+                rellenar_huellas(db)
+
+    huella = compute_fingerprint(ruta_foto)
+    hash_completo = None
+
+    candidatas = db.obtener_fotos_por_fingerprint(huella)
+    if candidatas:
+        hash_completo = calcular_hash_completo(ruta_foto)
+        for candidata in candidatas:
+            hash_candidata = candidata["hash_md5"]
+            # NULL, MD5 de una BD antigua u otro algoritmo: se recalcula para poder comparar
+            if not (hash_candidata or "").startswith(ALGORITMO_HASH + ":"):
+                if not os.path.exists(candidata["ruta_archivo"]):
+                    continue
+                hash_candidata = calcular_hash_completo(candidata["ruta_archivo"])
+                db.actualizar_hash_foto(candidata["id"], hash_candidata)
+            if hash_candidata == hash_completo:
+                logger.info("♻️ Foto duplicada: %s (ID %d)", ruta_foto, candidata['id'])
+                return candidata["id"]
+
+    return db.registrar_foto(ruta_foto, hash_completo, metadatos or {}, fingerprint=huella)
 
-            print(f"   -> Detectadas {len(caras)} caras.")
-            return caras
 
+class ArcFaceEmbedder:
+    '''Carga ArcFace y el detector de caras UNA sola vez y calcula los embeddings
+    de muchas fotos en una única pasada del modelo.
+    El detector es DETECTOR (YuNet) salvo que se indique otro o high_accuracy=True,
+    que usa DETECTOR_PRECISO (RetinaFace), más preciso pero mucho más lento en CPU.'''
+    def __init__(self, hilos=HILOS_DETECCION, detector=None, high_accuracy=False):
+        self.hilos = hilos
+        self.nombre_detector = detector or (DETECTOR_PRECISO if high_accuracy else DETECTOR)
+        logger.info("🚀 Iniciando sistema con %s y detector %s...", MODELO, self.nombre_detector)
+        self.modelo = DeepFace.build_model(MODELO)
+        # Precarga del detector en el hilo principal: DeepFace lo deja cacheado y
+        # extract_faces(detector_backend=...) reutiliza ese mismo modelo ya cargado
+        DeepFace.build_model(self.nombre_detector, task="face_detector")
+        self.alto, self.ancho = self.modelo.input_shape
+        # Con estos detectores solo la detección va en serie; decodificar,
+        # reducir y recortar las fotos sigue repartido entre los hilos
+        self._lock_deteccion = threading.Lock() if self.nombre_detector in DETECTORES_SIN_HILOS else nullcontext()
+
+    @staticmethod
+    def cargar_imagen(ruta_foto):
+        '''Decodifica la foto UNA vez (BGR, que es lo que espera DeepFace con arrays)
+        y la reduce si su lado mayor supera LADO_MAXIMO_DETECCION.
+        Devuelve (imagen, escala) o (None, 1.0) si no se puede leer.'''
+        imagen = cv2.imread(ruta_foto)
+        if imagen is None:
+            return None, 1.0
+
+        alto, ancho = imagen.shape[:2]
+        lado_mayor = max(alto, ancho)
+        if lado_mayor <= LADO_MAXIMO_DETECCION:
+            return imagen, 1.0
+
+        escala = LADO_MAXIMO_DETECCION / lado_mayor
+        imagen = cv2.resize(imagen, (round(ancho * escala), round(alto * escala)), interpolation=cv2.INTER_AREA)
+        return imagen, escala
+
+    @staticmethod
+    def _reescalar_area(area, escala):
+        '''Lleva las coordenadas de la imagen reducida a las de la foto original.'''
+        if escala == 1.0:
+            return area
+        reescalada = {}
+        for clave, valor in area.items():
+            if valor is None:
+                reescalada[clave] = None
+            elif isinstance(valor, (tuple, list)):  # ojos, boca...
+                reescalada[clave] = tuple(int(round(c / escala)) for c in valor)
+            else:
+                reescalada[clave] = int(round(valor / escala))
+        return reescalada
+
+    def detectar_caras(self, ruta_foto):
+        '''Detecta y alinea las caras de una foto. Devuelve los recortes ya
+        preparados para ArcFace junto con su área (en coordenadas de la foto
+        original) y confianza.'''
+        logger.debug("😃 Obteniendo caras: %s...", ruta_foto)
+
+        imagen, escala = self.cargar_imagen(ruta_foto)
+        if imagen is None:
+            logger.error("❌ Error: no se pudo decodificar la imagen %s", ruta_foto)
+            return []
+
+        try:
+            with self._lock_deteccion:
+                caras = DeepFace.extract_faces(
+                    img_path=imagen,
+                    detector_backend=self.nombre_detector,
+                    enforce_detection=True,
+                    align=True
+                )
         except ValueError:
-            print(f"⚠️ Aviso: No se detectó ninguna cara en {ruta_foto_nueva}.")
+            logger.debug("⚠️ Aviso: No se detectó ninguna cara en %s.", ruta_foto)
             return []
-            
         except Exception as e:
-            print(f"❌ Error inesperado procesando la imagen: {e}")
+            logger.error("❌ Error inesperado procesando la imagen: %s", e)
             return []
 
-    def procesando_caras(self, caras):
+        detectadas = []
+        for cara in caras:
+            # extract_faces devuelve RGB en [0, 1]; ArcFace espera BGR (igual que DeepFace.represent)
+            recorte = preprocessing.resize_image(img=cara["face"][:, :, ::-1], target_size=(self.alto, self.ancho))
+            detectadas.append({
+                "recorte": recorte,
+                "facial_area": self._reescalar_area(cara["facial_area"], escala),
+                "face_confidence": cara["confidence"]
+            })
+
+        logger.debug("   -> Detectadas %d caras.", len(detectadas))
+        return detectadas
+
+    def embed_batch(self, rutas_fotos):
+        '''Calcula los embeddings de todas las caras de varias fotos.
+        Devuelve una lista por foto con el mismo formato que DeepFace.represent,
+        con los embeddings ya normalizados (L2).'''
+        resultados = [[] for _ in rutas_fotos]
+        recortes = []
+        origen = []  # índice de la foto a la que pertenece cada recorte
+
+        # 1. Detección en paralelo (una foto por hilo)
+        if len(rutas_fotos) > 1 and self.hilos > 1:
+            with ThreadPoolExecutor(max_workers=self.hilos) as ejecutor:
+                detecciones = list(ejecutor.map(self.detectar_caras, rutas_fotos))
+        else:
+            detecciones = [self.detectar_caras(ruta) for ruta in rutas_fotos]
+
+        for i, caras in enumerate(detecciones):
+            for cara in caras:
+                recortes.append(cara["recorte"])
+                origen.append((i, cara))
+
+        if not recortes:
+            return resultados
+
+        # 2. Un único lote (N, alto, ancho, 3) en lugar de una llamada al modelo por cara
+        lote = np.concatenate(recortes, axis=0, dtype=np.float32)
+        # float32 desde el origen: FAISS y la base de datos ya no necesitan copiarlos.
+        # predict_on_batch en trozos de TAMANIO_LOTE: una pasada directa del grafo, sin el
+        # pipeline tf.data ni los callbacks que monta predict() en cada llamada
+        embeddings = np.empty((len(lote), DIMENSION_EMBEDDING), dtype=np.float32)
+        for inicio in range(0, len(lote), TAMANIO_LOTE):
+            trozo = lote[inicio:inicio + TAMANIO_LOTE]
+            embeddings[inicio:inicio + len(trozo)] = self.modelo.model.predict_on_batch(trozo)
+        # Normalizados aquí, una vez: DatabaseManager los usa tal cual, sin copias
+        normalizar_matriz(embeddings)
+
+        for (i, cara), embedding in zip(origen, embeddings):
+            resultados[i].append({
+                "embedding": embedding,
+                "facial_area": cara["facial_area"],
+                "face_confidence": cara["face_confidence"]
+            })
+
+        return resultados
+
+
+_embedders = {}  # Un ArcFaceEmbedder por detector
+_embedder_lock = threading.Lock()
+
+def obtener_embedder(high_accuracy=False):
+    '''Devuelve el ArcFaceEmbedder del proceso, creándolo la primera vez.
+    Con lock: dos hilos que arrancan a la vez no cargan los modelos dos veces.'''
+    detector = DETECTOR_PRECISO if high_accuracy else DETECTOR
+    if detector not in _embedders:
+        with _embedder_lock:
+            if detector not in _embedders:
+                _embedders[detector] = ArcFaceEmbedder(detector=detector)
+    return _embedders[detector]
+
+
+class ProcesadorDeFotos:
+    '''Se encarga de:
+        - calcular los embeddings de las caras de un lote de fotos
+        - registrar nuevas personas
+        - añadir las etiquetas
+    Un mismo DatabaseManager se comparte entre todas las fotos del lote.'''
+    def __init__(self, db=None, high_accuracy=False):
+        self.db = db if db is not None else DatabaseManager()
+        self.embedder = obtener_embedder(high_accuracy)
+
+    def validar_foto(self, id_foto):
+        '''Devuelve la ruta de la foto o lanza un error si no existe.'''
+        ruta_foto = self.db.obtener_ruta_foto(id_foto)
+
+        if not ruta_foto:
+            raise ValueError(f"❌ Error: No existe la foto con ID {id_foto} en la base de datos.")
+        
+        if not os.path.exists(ruta_foto):
+            raise FileNotFoundError(f"❌ Error: El archivo físico no existe: {ruta_foto}")
+
+        return ruta_foto
+
+    def obtener_caras(self, ruta_foto_nueva):
+        '''Obtiene las caras (con su embedding) de una sola foto.'''
+        return self.embedder.embed_batch([ruta_foto_nueva])[0]
+
+    def procesando_caras(self, id_foto, caras, identificadas=None):
         '''Dada una cara:
-            1. busca coincidencias en la base de datos FAISS:
-                a. Si no encuentra coincidencia -> añadir a FAISS y crear persona
-            2. añadir la etiqueta de la persona a la foto'''
+            1. busca coincidencias en la base de datos FAISS
+               (o usa las ya buscadas en lote: identificadas = (ids, distancias, embeddings)):
+                a. Si no encuentra coincidencia -> se acumula como desconocida
+            2. registra todas las desconocidas de la foto en un solo lote
+            3. añadir la etiqueta de la persona a la foto'''
             
-        ids_encontrados = []
+        if identificadas is None:
+            # Todas las caras de la foto en un buffer (N, 512) C-contiguo: una sola búsqueda
+            # FAISS y sin copias ocultas al cruzar a C++
+            embeddings = np.empty((len(caras), DIMENSION_EMBEDDING), dtype=np.float32)
+            for i, cara in enumerate(caras):
+                embeddings[i] = cara["embedding"]
+            ids_encontrados, distancias = self.db.identificar_personas_batch(embeddings, umbral=UMBRAL_COINCIDENCIA)
+        else:
+            ids_encontrados, distancias, embeddings = identificadas
+        assert embeddings.flags['C_CONTIGUOUS']
+        desconocidas = []  # índices de las caras sin coincidencia
         
-        for i, cara in enumerate(caras):
-            embedding = np.array(cara["embedding"], dtype='float32') # convertilo en un bloque de memoria contiguo
+        for i, id_persona in enumerate(ids_encontrados):
+            logger.debug("   🔍 Analizando cara %d...", i + 1)
             
-            print(f"\n   🔍 Analizando cara {i+1}...")
-            
-            id_persona, distancia = self.db.identificar_persona_por_vector(embedding)
-            
-            if id_persona:
-                ids_encontrados.append(id_persona)
-            else:
-                nuevo_id = self.db.registrar_nueva_persona(
-                    foto_id=15,
-                    embedding=embedding,
-                    area=cara["facial_area"],
-                    nombre="Desconocido"
-                )
-                print(f"      🆕 DESCONOCIDO: Registrado como ID {nuevo_id}")
-                print(f"      (Distancia más cercana: {distancia:.4f})")
-                ids_encontrados.append(nuevo_id)
+            if not id_persona:
+                logger.debug("      🆕 DESCONOCIDO (Distancia más cercana: %.4f)", distancias[i])
+                desconocidas.append(i)
+
+        if desconocidas:
+            nuevos_ids = self.db.registrar_personas_batch(
+                foto_id=id_foto,
+                embeddings=embeddings[desconocidas],
+                areas=[caras[i]["facial_area"] for i in desconocidas]
+            )
+            for i, nuevo_id in zip(desconocidas, nuevos_ids):
+                ids_encontrados[i] = nuevo_id
         
-        print(f"\n✅ Procesamiento completado. IDs encontrados: {ids_encontrados}")
+        logger.debug("✅ Procesamiento completado. IDs encontrados: %s", ids_encontrados)
         return ids_encontrados
 
-    def añadir_etiquetas(self, ids_encontrados):
+    def añadir_etiquetas(self, id_foto, ids_encontrados):
         """
         Recorre los IDs de personas detectadas, busca sus etiquetas correspondientes
-        y las asigna a la foto actual usando el DatabaseManager.
+        y las asigna a la foto indicada usando el DatabaseManager.
         """
         if not ids_encontrados:
             return
 
-        print(f"🏷️ Asignando etiquetas para {len(ids_encontrados)} personas...")
+        logger.debug("🏷️ Asignando etiquetas para %d personas...", len(ids_encontrados))
+
+        # 1. Averiguar las etiquetas de todas las personas con una sola consulta
+        etiquetas_de = self.db.obtener_etiquetas_de_personas(ids_encontrados)
+        etiquetas_ids = []
 
         for persona_id in ids_encontrados:
-            # 1. Averiguar cuál es la etiqueta de esta persona
-            etiqueta_id = self.db.obtener_etiqueta_id_de_persona(persona_id)
+            etiqueta_id = etiquetas_de.get(persona_id)
             
             if etiqueta_id:
-                # 2. Usar el método genérico del Manager para asignar
-                # Asumimos que tienes el ID de la foto actual guardado en self.foto_id_actual
-                # Si no, pásalo como argumento a esta función.
-                self.db.asignar_etiqueta(
-                    foto_id=self.foto_id_actual, 
-                    etiqueta_id=etiqueta_id, 
-                    manual=False # Es automático
-                )
-                print(f"   -> Etiqueta (ID {etiqueta_id}) asignada a foto {self.foto_id_actual}")
+                etiquetas_ids.append(etiqueta_id)
+                logger.debug("   -> Etiqueta (ID %d) asignada a foto %d", etiqueta_id, id_foto)
             else:
-                print(f"   ⚠️ La persona ID {persona_id} no tiene etiqueta vinculada.")
+                logger.warning("   ⚠️ La persona ID %s no tiene etiqueta vinculada.", persona_id)
+
+        # 2. Usar el método genérico del Manager para asignarlas todas de golpe
+        if etiquetas_ids:
+            self.db.asignar_etiquetas(
+                foto_id=id_foto, 
+                etiquetas_ids=etiquetas_ids, 
+                manual=False # Es automático
+            )
+
+    def guardar_resultados(self, id_foto, caras, identificadas=None):
+        """Registra las caras de una foto ya procesada por el modelo."""
+        logger.debug("📸 --- PROCESANDO FOTO ID: %d ---", id_foto)
 
-    def procesar_foto(self, ruta_foto):
-        """
-        Método maestro que ejecuta todo el flujo.
-        """
-        print(f"📸 --- PROCESANDO FOTO ID: {self.id_foto} ---")
-        
-        caras = self.obtener_caras()
-        
         if not caras:
-            print("⏹️ Fin del procesamiento (sin caras).")
-            self.db.marcar_foto_como_procesada(self.id_foto)
+            logger.debug("⏹️ Fin del procesamiento (sin caras).")
+            self.db.marcar_foto_como_procesada(id_foto)
             return
 
-        ids_personas = self.procesando_caras(caras)
+        ids_personas = self.procesando_caras(id_foto, caras, identificadas)
         
-        self.añadir_etiquetas(ids_personas)
+        self.añadir_etiquetas(id_foto, ids_personas)
         
-        self.db.marcar_foto_como_procesada(self.id_foto)
+        self.db.marcar_foto_como_procesada(id_foto)
         
-        print(f"✅ FOTO {self.id_foto} COMPLETADA.\n")
+        logger.debug("✅ FOTO %d COMPLETADA.", id_foto)
+
+    def process_many(self, ids_fotos):
+        """
+        Método maestro: calcula los embeddings de todas las fotos en un solo
+        lote (detección en paralelo) y después guarda los resultados foto a
+        foto en el hilo principal, que es el único que escribe en SQL/FAISS.
+        """
+        fotos = []
+        for id_foto in ids_fotos:
+            try:
+                fotos.append((id_foto, self.validar_foto(id_foto)))
+            except (ValueError, FileNotFoundError) as e:
+                logger.warning("%s", e)
+                # Fuera de las pendientes: procesar_pendientes no vuelve a pedirla
+                self.db.marcar_foto_con_error(id_foto)
+
+        self._procesar_validadas(fotos)
+
+    def _procesar_validadas(self, fotos):
+        """Resto de process_many para una lista de (id_foto, ruta) ya validadas."""
+        if not fotos:
+            return
+
+        caras_por_foto = self.embedder.embed_batch([ruta for _, ruta in fotos])
+
+        # Una sola búsqueda FAISS para las caras de TODAS las fotos del lote
+        identificadas = self.identificar_lote(caras_por_foto)
+
+        for (id_foto, _), caras, resultado in zip(fotos, caras_por_foto, identificadas):
+            self.guardar_resultados(id_foto, caras, resultado)
+
+        # Un único volcado del índice FAISS por lote, no uno por cara
+        self.db.guardar_cambios_faiss()
+
+    def identificar_lote(self, caras_por_foto):
+        """
+        Busca en FAISS todas las caras de varias fotos en una sola llamada.
+        Devuelve, por foto, (ids de persona, distancias, embeddings); embeddings
+        es una vista sin copia de sus filas en la matriz del lote. Es un
+        generador: las caras que salen desconocidas se vuelven a buscar si fotos
+        anteriores del lote han registrado personas nuevas (pueden ser la misma persona).
+        """
+        tamanios = [len(caras) for caras in caras_por_foto]
+        todas = [cara["embedding"] for caras in caras_por_foto for cara in caras]
+        if not todas:
+            yield from (None for _ in caras_por_foto)
+            return
+
+        embeddings = np.empty((len(todas), DIMENSION_EMBEDDING), dtype=np.float32)  # C-contiguo
+        for i, embedding in enumerate(todas):
+            embeddings[i] = embedding
+        ids, distancias = self.db.identificar_personas_batch(embeddings, umbral=UMBRAL_COINCIDENCIA)
+        ntotal_inicial = self.db.index.ntotal
+
+        inicio = 0
+        for n in tamanios:
+            fin = inicio + n
+            ids_foto, distancias_foto = ids[inicio:fin], distancias[inicio:fin]
+            embeddings_foto = embeddings[inicio:fin]  # filas consecutivas: sigue siendo C-contiguo
+            pendientes = [i for i, id_persona in enumerate(ids_foto) if not id_persona]
+
+            if pendientes and self.db.index.ntotal != ntotal_inicial:
+                nuevos_ids, nuevas_distancias = self.db.identificar_personas_batch(
+                    embeddings_foto[pendientes], umbral=UMBRAL_COINCIDENCIA
+                )
+                for i, id_persona, distancia in zip(pendientes, nuevos_ids, nuevas_distancias):
+                    ids_foto[i], distancias_foto[i] = id_persona, distancia
+
+            yield (ids_foto, distancias_foto, embeddings_foto) if n else None
+            inicio = fin
+
+    def procesar_foto(self, id_foto):
+        """Procesa una única foto (lanza error si no existe)."""
+        ruta_foto = self.validar_foto(id_foto)
+        # Directo al lote: process_many volvería a consultar la ruta en SQL
+        self._procesar_validadas([(id_foto, ruta_foto)])
+
+    def procesar_pendientes(self, limite=TAMANIO_LOTE_FOTOS):
+        """Procesa las fotos que aún no han pasado por el reconocimiento facial."""
+        ids_fotos = self.db.obtener_fotos_pendientes(limite)
+        logger.info("🗂️ %d fotos pendientes de procesar.", len(ids_fotos))
+        self.process_many(ids_fotos)
+        return ids_fotos
 
         '''Ejemplo de uso:
-        # Supongamos que acabas de importar una foto y tienes su ID (ej. 100)
+        # Supongamos que acabas de importar varias fotos y tienes sus IDs
+        logging.basicConfig(level=logging.INFO)  # DEBUG para ver el detalle de cada cara
         try:
-            procesador = ProcesadorDeFotos(100) # Él solo busca la ruta y se prepara
-            procesador.procesar()               # Hace toda la magia
+            procesador = ProcesadorDeFotos()      # Carga el modelo y la base de datos una vez
+            procesador.process_many([100, 101])   # Hace toda la magia en lote
+            procesador.procesar_pendientes()      # O procesa todo lo que falte
+            # ProcesadorDeFotos(high_accuracy=True) detecta con RetinaFace (más lento en CPU)
         except Exception as e:
             print(f"Error: {e}")'''
\ No newline at end of file
@@ -0,0 +1,82 @@
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "backend"))
+
+import init_dbs  # noqa: E402
+import db_manager  # noqa: E402
+from db_manager import DatabaseManager  # noqa: E402
+
+
+@unittest.skipUnless(db_manager.ROCKSDICT_DISPONIBLE, "rocksdict no está instalado")
+class TestCachePersonas(unittest.TestCase):
+    """La caché rostro -> persona no sobrevive a una galeria.db creada de nuevo."""
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.db_path_original = init_dbs.DB_PATH
+        self.vectores = np.random.default_rng(0).standard_normal((2, init_dbs.DIMENSION_EMBEDDING)).astype(np.float32)
+
+    def tearDown(self):
+        init_dbs.DB_PATH = self.db_path_original
+        shutil.rmtree(self.dir)
+
+    def _ruta(self, nombre):
+        return os.path.join(self.dir, nombre)
+
+    def _crear_bd(self):
+        """galeria.db nueva (con su índice y respaldo); la caché se conserva."""
+        for nombre in ("galeria.db", "galeria.db-wal", "galeria.db-shm", "embeddings.index", "embeddings.f32"):
+            if os.path.exists(self._ruta(nombre)):
+                os.remove(self._ruta(nombre))
+        init_dbs.DB_PATH = self._ruta("galeria.db")
+        init_dbs.init_sql()
+
+    def _abrir(self, solo_lectura=False):
+        return DatabaseManager(self._ruta("galeria.db"), self._ruta("embeddings.index"),
+                               embeddings_path=self._ruta("embeddings.f32"),
+                               solo_lectura=solo_lectura, kv_path=self._ruta("personas.rocks"))
+
+    def test_bd_nueva_vacia_la_cache(self):
+        self._crear_bd()
+        db = self._abrir()
+        foto_id = db.registrar_foto("/fotos/a.jpg", "h1", {})
+        db.registrar_personas_batch(foto_id, self.vectores, [{"x": 0, "y": 0, "w": 1, "h": 1}] * 2)
+        self.assertEqual(db.cache_personas.obtener([1, 2]), {1: 1, 2: 2})
+        db.cerrar()
+
+        # Mismos ids de rostro en la BD nueva, pero sin persona
+        self._crear_bd()
+        db = self._abrir()
+        foto_id = db.registrar_foto("/fotos/b.jpg", "h2", {})
+        areas = {"x": 0, "y": 0, "w": 1, "h": 1}
+        db.guardar_rostros_detectados(foto_id, [{"embedding": v, "facial_area": areas, "face_confidence": 0.9}
+                                                for v in self.vectores])
+        self.assertEqual(db.cache_personas.obtener([1, 2]), {})
+        self.assertEqual(db._personas_de_rostros([1, 2]), {1: None, 2: None})
+        db.cerrar()
+
+    def test_lector_no_usa_cache_de_otra_bd(self):
+        self._crear_bd()
+        db = self._abrir()
+        foto_id = db.registrar_foto("/fotos/a.jpg", "h1", {})
+        db.registrar_personas_batch(foto_id, self.vectores[:1], [{"x": 0, "y": 0, "w": 1, "h": 1}])
+        db.cerrar()
+
+        lector = self._abrir(solo_lectura=True)
+        self.assertIsNotNone(lector.cache_personas)
+        lector.cerrar()
+
+        self._crear_bd()
+        lector = self._abrir(solo_lectura=True)
+        self.assertIsNone(lector.cache_personas)
+        lector.cerrar()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,115 @@
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "backend"))
+
+import init_dbs  # noqa: E402
+import db_manager  # noqa: E402
+from db_manager import DatabaseManager  # noqa: E402
+
+TIPOS = ["hnsw", "flat", "sq8", "fp16", "ivfflat", "ivfsq8", "ivfpq"]
+N_ROSTROS = 1000
+
+
+class TestEliminarRostro(unittest.TestCase):
+    """Borrar un rostro y buscar después, con cada TIPO_INDICE."""
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.config = {
+            (init_dbs, "TIPO_INDICE"): init_dbs.TIPO_INDICE,
+            (init_dbs, "IVF_NLIST"): init_dbs.IVF_NLIST,
+            (init_dbs, "IVFPQ_FACTORY"): init_dbs.IVFPQ_FACTORY,
+            (init_dbs, "DB_PATH"): init_dbs.DB_PATH,
+            (db_manager, "IVFFLAT_MUESTRAS_ENTRENAMIENTO"): db_manager.IVFFLAT_MUESTRAS_ENTRENAMIENTO,
+            (db_manager, "SQ_MUESTRAS_ENTRENAMIENTO"): db_manager.SQ_MUESTRAS_ENTRENAMIENTO,
+        }
+        # Índices pequeños: se entrenan con N_ROSTROS caras
+        init_dbs.IVF_NLIST = 16
+        init_dbs.IVFPQ_FACTORY = "IVF16,PQ64"
+        db_manager.IVFFLAT_MUESTRAS_ENTRENAMIENTO = 500
+        db_manager.SQ_MUESTRAS_ENTRENAMIENTO = 500
+
+        rng = np.random.default_rng(0)
+        self.vectores = rng.standard_normal((N_ROSTROS, init_dbs.DIMENSION_EMBEDDING)).astype(np.float32)
+        self.vectores /= np.linalg.norm(self.vectores, axis=1, keepdims=True)
+
+    def tearDown(self):
+        for (modulo, nombre), valor in self.config.items():
+            setattr(modulo, nombre, valor)
+        shutil.rmtree(self.dir)
+
+    def _abrir(self, tipo):
+        init_dbs.TIPO_INDICE = tipo
+        ruta = lambda nombre: os.path.join(self.dir, tipo, nombre)
+        return DatabaseManager(ruta("galeria.db"), ruta("embeddings.index"),
+                               embeddings_path=ruta("embeddings.f32"),
+                               solo_lectura=False, kv_path=ruta("personas.rocks"))
+
+    def _crear(self, tipo):
+        os.makedirs(os.path.join(self.dir, tipo))
+        init_dbs.DB_PATH = os.path.join(self.dir, tipo, "galeria.db")
+        init_dbs.init_sql()
+        db = self._abrir(tipo)
+        foto_id = db.registrar_foto("/fotos/grupo.jpg", "hash", {})
+        areas = [{"x": 0, "y": 0, "w": 1, "h": 1}] * N_ROSTROS
+        db.registrar_personas_batch(foto_id, self.vectores, areas)
+        return db
+
+    def _comprobar(self, db, tipo, borrados):
+        # Base de datos nueva: el rostro i tiene id i + 1
+        for i in borrados:
+            encontrados = [r["id_rostro"] for r in db.buscar_rostros_similares(self.vectores[i], limite=10, umbral_coseno=2.0)]
+            self.assertNotIn(i + 1, encontrados, tipo)
+            self.assertEqual(len(encontrados), 10, tipo)
+
+        restantes = [i for i in range(0, N_ROSTROS, 25) if i not in borrados]
+        for i in restantes:
+            encontrados = [r["id_rostro"] for r in db.buscar_rostros_similares(self.vectores[i], limite=10, umbral_coseno=2.0)]
+            self.assertIn(i + 1, encontrados, tipo)
+
+    def test_borrar_y_buscar(self):
+        borrados = [4, 70, 301]
+        for tipo in TIPOS:
+            with self.subTest(tipo=tipo):
+                db = self._crear(tipo)
+                self.assertTrue(db.index.is_trained)
+                for i in borrados:
+                    self.assertTrue(db.eliminar_rostro(i + 1))
+                self.assertFalse(db.eliminar_rostro(borrados[0] + 1))
+                self._comprobar(db, tipo, borrados)
+                db.cerrar()
+
+                # Al reabrir, los borrados siguen fuera aunque el índice aún los tenga
+                db = self._abrir(tipo)
+                self._comprobar(db, tipo, borrados)
+
+                db._reconstruir_indice()
+                self.assertFalse(db._borrados)
+                self.assertEqual(db.index.ntotal, N_ROSTROS - len(borrados))
+                self._comprobar(db, tipo, borrados)
+                db.cerrar()
+
+    def test_hnsw_no_reconstruye_en_cada_borrado(self):
+        db = self._crear("hnsw")
+        indice = db.index
+        db.eliminar_rostro(1)
+        self.assertIs(db.index, indice)
+        self.assertEqual(db._borrados, {1})
+
+        # Pasado FRACCION_BORRADOS_RECONSTRUIR se reconstruye en segundo plano
+        for rostro_id in range(2, int(N_ROSTROS * db_manager.FRACCION_BORRADOS_RECONSTRUIR) + 3):
+            db.eliminar_rostro(rostro_id)
+        db._hilo_reconstruccion.join()
+        self.assertIsNot(db.index, indice)
+        self.assertLess(db.index.ntotal, N_ROSTROS)
+        db.cerrar()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,115 @@
+import os
+import sys
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "backend"))
+
+from db_manager import DatabaseManager  # noqa: E402
+
+# Esquema de la primera versión (init_sql de antes de fingerprint_fast)
+SQL_SCHEMA_ORIGINAL = """
+PRAGMA foreign_keys = ON;
+
+CREATE TABLE IF NOT EXISTS fotos (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    ruta_archivo TEXT NOT NULL UNIQUE,
+    hash_md5 TEXT UNIQUE,
+    fecha_creacion TIMESTAMP,
+    fecha_importacion TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    ancho INTEGER,
+    alto INTEGER,
+    tamanio_bytes INTEGER,
+    procesada_facial BOOLEAN DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS idx_fotos_hash ON fotos(hash_md5);
+CREATE INDEX IF NOT EXISTS idx_fotos_fecha ON fotos(fecha_creacion);
+
+CREATE TABLE IF NOT EXISTS personas (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    nombre TEXT NOT NULL DEFAULT 'Desconocido',
+    es_conocida BOOLEAN DEFAULT 0,
+    foto_avatar_id INTEGER,
+    etiqueta_id INTEGER,
+    fecha_registro TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    FOREIGN KEY (foto_avatar_id) REFERENCES fotos(id) ON DELETE SET NULL,
+    FOREIGN KEY (etiqueta_id) REFERENCES etiquetas(id) ON DELETE SET NULL
+);
+
+CREATE TABLE IF NOT EXISTS rostros_detectados (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    foto_id INTEGER NOT NULL,
+    persona_id INTEGER,
+    bbox_x INTEGER, bbox_y INTEGER,
+    bbox_w INTEGER, bbox_h INTEGER,
+    score_confianza REAL,
+    embedding_blob BLOB,
+    FOREIGN KEY (foto_id) REFERENCES fotos(id) ON DELETE CASCADE,
+    FOREIGN KEY (persona_id) REFERENCES personas(id) ON DELETE SET NULL
+);
+CREATE INDEX IF NOT EXISTS idx_rostros_persona ON rostros_detectados(persona_id);
+
+CREATE TABLE IF NOT EXISTS etiquetas (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    texto TEXT NOT NULL UNIQUE,
+    tipo TEXT DEFAULT 'general',
+    color TEXT
+);
+
+CREATE TABLE IF NOT EXISTS fotos_etiquetas (
+    foto_id INTEGER NOT NULL,
+    etiqueta_id INTEGER NOT NULL,
+    asignacion_manual BOOLEAN DEFAULT 1,
+    PRIMARY KEY (foto_id, etiqueta_id),
+    FOREIGN KEY (foto_id) REFERENCES fotos(id) ON DELETE CASCADE,
+    FOREIGN KEY (etiqueta_id) REFERENCES etiquetas(id) ON DELETE CASCADE
+);
+"""
+
+
+class TestMigrarEsquema(unittest.TestCase):
+    """DatabaseManager sobre una BD creada con el esquema original, sin init_sql."""
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.db_path = os.path.join(self.dir, "galeria.db")
+        conn = sqlite3.connect(self.db_path)
+        conn.executescript(SQL_SCHEMA_ORIGINAL)
+        conn.execute("INSERT INTO fotos (ruta_archivo, hash_md5) VALUES ('/fotos/antigua.jpg', ?)", ("0" * 32,))
+        conn.commit()
+        conn.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def _abrir(self):
+        ruta = lambda nombre: os.path.join(self.dir, nombre)
+        return DatabaseManager(self.db_path, ruta("embeddings.index"), embeddings_path=ruta("embeddings.f32"),
+                               solo_lectura=False, kv_path=ruta("personas.rocks"))
+
+    def test_abrir_bd_original(self):
+        db = self._abrir()
+        try:
+            with db.pool.read() as cursor:
+                columnas = {fila["name"] for fila in cursor.execute("PRAGMA table_info(fotos)")}
+            self.assertIn("fingerprint_fast", columnas)
+
+            foto_id = db.registrar_foto("/fotos/nueva.jpg", "blake3:ab", {}, fingerprint="blake3:cd")
+            self.assertEqual([f["id"] for f in db.obtener_fotos_por_fingerprint("blake3:cd")], [foto_id])
+
+            # La foto antigua queda pendiente de huella hasta que la rellene rellenar_huellas
+            sin_huella = db.obtener_fotos_sin_huella("blake3:")
+            self.assertEqual([f["ruta_archivo"] for f in sin_huella], ["/fotos/antigua.jpg"])
+            db.actualizar_huellas({sin_huella[0]["id"]: "blake3:ef"})
+            self.assertEqual(db.obtener_fotos_sin_huella("blake3:"), [])
+        finally:
+            db.cerrar()
+
+        # Segunda apertura: la migración no se repite ni falla
+        self._abrir().cerrar()
+
+
+if __name__ == "__main__":
+    unittest.main()